@@ -0,0 +1,212 @@
+# Copyright NetApp 2023. Developed by NetApp Solutions Engineering Team
+#
+# Description:  Fleet configuration for the FSx ONTAP monitoring Lambda function.
+#               The configuration can be loaded from a JSON or YAML file or from an SSM parameter and
+#               allows per-SVM and per-volume policy overrides on top of the file system settings.
+#               Without a fleet configuration, the file systems in vars.fsxList are used as-is.
+#
+# Example:
+#   {
+#       "defaults": {"resize_threshold": 90, "growth_percent": 5},
+#       "fileSystems": [
+#           {
+#               "fsxMgmtIp": "10.0.0.10",
+#               "fsxId": "fs-0123456789abcdef0",
+#               "username": "fsxadmin",
+#               "fsx_password_ssm_parameter": "/fsxn/password",
+#               "exclude_svms": ["scratch*", "temp*"],
+#               "rules": [
+#                   {"svm": "prod", "volume": "db_*", "resize_threshold": 85, "growth_percent": 10, "max_size_in_gb": 2048},
+#                   {"volume": "*_tmp", "exclude": true}
+#               ]
+#           }
+#       ]
+#   }
+import json
+import re
+import fnmatch
+import logging
+logger = logging.getLogger()
+
+#settings that can be overridden per file system, SVM or volume
+POLICY_DEFAULTS = {
+    "resize_threshold": 90,
+    "warn_notification": True,
+    "growth_percent": 5,
+    "max_size_in_gb": None,
+    "exclude": False,
+    "enable_snapshot_deletion": True,
+    "snapshot_age_threshold_in_days": 30
+}
+FILE_SYSTEM_REQUIRED_KEYS = ["fsxMgmtIp", "fsxId", "username", "fsx_password_ssm_parameter"]
+FILE_SYSTEM_FILTER_KEYS = ["include_svms", "exclude_svms", "include_volumes", "rules"]
+FILE_SYSTEM_OPTIONAL_KEYS = ["scan_interval_in_seconds", "role_arn", "region"]
+RULE_MATCH_KEYS = ["svm", "volume"]
+
+def loadFleetConfig(source, ssm=None):
+    #source is a path to a .json/.yaml file or "ssm:<parameter name>"
+    logger.info("Loading fleet configuration from %s", source)
+    if source.startswith("ssm:"):
+        ssm_response = ssm.get_parameter(Name=source[len("ssm:"):], WithDecryption=True)
+        content = ssm_response['Parameter']['Value']
+    else:
+        with open(source) as f:
+            content = f.read()
+    return parseFleetConfig(content, source.endswith((".yaml", ".yml")))
+
+def parseFleetConfig(content, is_yaml=False):
+    if is_yaml or not content.lstrip().startswith("{"):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError("PyYAML is required to load a YAML fleet configuration")
+        config = yaml.safe_load(content)
+    else:
+        config = json.loads(content)
+    return validateFleetConfig(config)
+
+def getLegacyFleetConfig(fsx_list):
+    #vars.fsxList entries carry the file system wide policy
+    return validateFleetConfig({"defaults": {}, "fileSystems": fsx_list})
+
+def validateFleetConfig(config):
+    #returns the list of file systems with defaults applied, raises ValueError listing every problem
+    errors = []
+    if not isinstance(config, dict):
+        raise ValueError("Fleet configuration must be a mapping")
+    for key in config:
+        if key not in ["defaults", "fileSystems"]:
+            errors.append("Unknown top level key: {}".format(key))
+    defaults = dict(POLICY_DEFAULTS)
+    defaults.update(config.get("defaults") or {})
+    errors += validatePolicy(defaults, "defaults")
+
+    file_systems = config.get("fileSystems")
+    if not isinstance(file_systems, list) or not file_systems:
+        errors.append("fileSystems must be a non-empty list")
+        file_systems = []
+
+    fsx_list = []
+    for i, fs in enumerate(file_systems):
+        where = "fileSystems[{}]".format(i)
+        if not isinstance(fs, dict):
+            errors.append("{} must be a mapping".format(where))
+            continue
+        fsx = dict(defaults)
+        fsx.update({"include_svms": [], "exclude_svms": [], "include_volumes": [], "rules": []})
+        fsx.update(fs)
+        for key in FILE_SYSTEM_REQUIRED_KEYS:
+            if not fsx.get(key):
+                errors.append("{} is missing {}".format(where, key))
+        for key in fsx:
+            if key not in POLICY_DEFAULTS and key not in FILE_SYSTEM_REQUIRED_KEYS and key not in FILE_SYSTEM_FILTER_KEYS and key not in FILE_SYSTEM_OPTIONAL_KEYS:
+                errors.append("{} has unknown key {}".format(where, key))
+        errors += validatePolicy(fsx, where)
+        for key in ["role_arn", "region"]:
+            if fsx.get(key) is not None and not isinstance(fsx[key], str):
+                errors.append("{}.{} must be a string".format(where, key))
+        if fsx.get("scan_interval_in_seconds") is not None and not (isinstance(fsx["scan_interval_in_seconds"], (int, float)) and fsx["scan_interval_in_seconds"] > 0):
+            errors.append("{}.scan_interval_in_seconds must be a positive number".format(where))
+        for key in ["include_svms", "exclude_svms", "include_volumes"]:
+            if not isinstance(fsx[key], list) or not all(isinstance(p, str) for p in fsx[key]):
+                errors.append("{}.{} must be a list of name patterns".format(where, key))
+        if not isinstance(fsx["rules"], list):
+            errors.append("{}.rules must be a list".format(where))
+            fsx["rules"] = []
+        for j, rule in enumerate(fsx["rules"]):
+            rule_where = "{}.rules[{}]".format(where, j)
+            if not isinstance(rule, dict):
+                errors.append("{} must be a mapping".format(rule_where))
+                continue
+            for key in rule:
+                if key not in POLICY_DEFAULTS and key not in RULE_MATCH_KEYS:
+                    errors.append("{} has unknown key {}".format(rule_where, key))
+            for key in RULE_MATCH_KEYS:
+                if not isinstance(rule.get(key, "*"), str):
+                    errors.append("{}.{} must be a name pattern".format(rule_where, key))
+            errors += validatePolicy(rule, rule_where)
+        fsx_list.append(fsx)
+
+    if errors:
+        raise ValueError("Invalid fleet configuration: " + "; ".join(errors))
+    for fsx in fsx_list:
+        fsx["policy_matcher"] = compilePolicyMatcher(fsx)
+    return fsx_list
+
+def validatePolicy(policy, where):
+    errors = []
+    if "resize_threshold" in policy and not (isinstance(policy["resize_threshold"], (int, float)) and 0 < policy["resize_threshold"] <= 100):
+        errors.append("{}.resize_threshold must be a percentage between 0 and 100".format(where))
+    if "growth_percent" in policy and not (isinstance(policy["growth_percent"], (int, float)) and policy["growth_percent"] > 0):
+        errors.append("{}.growth_percent must be a positive number".format(where))
+    if policy.get("max_size_in_gb") is not None and not (isinstance(policy["max_size_in_gb"], (int, float)) and policy["max_size_in_gb"] > 0):
+        errors.append("{}.max_size_in_gb must be a positive number".format(where))
+    if "snapshot_age_threshold_in_days" in policy and not (isinstance(policy["snapshot_age_threshold_in_days"], int) and policy["snapshot_age_threshold_in_days"] >= 0):
+        errors.append("{}.snapshot_age_threshold_in_days must be a non-negative integer".format(where))
+    for key in ["warn_notification", "exclude", "enable_snapshot_deletion"]:
+        if key in policy and not isinstance(policy[key], bool):
+            errors.append("{}.{} must be true or false".format(where, key))
+    return errors
+
+def compilePatterns(patterns):
+    #a single regex for a list of shell-style patterns, None matches everything
+    if not patterns:
+        return None
+    return re.compile("|".join("(?:{})".format(fnmatch.translate(p)) for p in patterns)).match
+
+def compilePolicyMatcher(fsx):
+    #returns getPolicy(svm, volume) resolving file system settings and every matching rule in order
+    base = {key: fsx[key] for key in POLICY_DEFAULTS}
+    include_svms = compilePatterns(fsx["include_svms"])
+    exclude_svms = compilePatterns(fsx["exclude_svms"])
+    include_volumes = compilePatterns(fsx["include_volumes"])
+    rules = []
+    for rule in fsx["rules"]:
+        overrides = {key: rule[key] for key in POLICY_DEFAULTS if key in rule}
+        rules.append((compilePatterns([rule.get("svm", "*")]), compilePatterns([rule.get("volume", "*")]), overrides))
+    cache = {}
+
+    def getPolicy(svm, volume):
+        key = (svm, volume)
+        if key not in cache:
+            policy = dict(base)
+            if (include_svms and not include_svms(svm)) or (exclude_svms and exclude_svms(svm)) or (include_volumes and not include_volumes(volume)):
+                policy["exclude"] = True
+            for svm_match, volume_match, overrides in rules:
+                if svm_match(svm) and volume_match(volume):
+                    policy.update(overrides)
+            cache[key] = policy
+        return cache[key]
+    return getPolicy
+
+def hasFilters(fsx):
+    return bool(fsx["include_svms"] or fsx["exclude_svms"] or fsx["include_volumes"] or any(rule.get("exclude") for rule in fsx["rules"]))
+
+def getIncludedSvms(fsx, svm_names):
+    include_svms = compilePatterns(fsx["include_svms"])
+    exclude_svms = compilePatterns(fsx["exclude_svms"])
+    return [svm for svm in svm_names if (include_svms is None or include_svms(svm)) and not (exclude_svms and exclude_svms(svm))]
+
+#ONTAP queries only support the * wildcard, other shell-style syntax or query operators are matched on the listing
+ONTAP_QUERY_UNSAFE = re.compile(r"[?\[\]|!<>]")
+
+def isOntapPattern(pattern):
+    return not ONTAP_QUERY_UNSAFE.search(pattern)
+
+def getOntapFilterQuery(fsx, svm_names, prefix=""):
+    #ONTAP query parameters selecting the included SVMs and volumes, prefix is "location." for LUNs
+    query = {}
+    volume_field = prefix + "volume.name" if prefix else "name"
+    if fsx["include_svms"] or fsx["exclude_svms"]:
+        included = getIncludedSvms(fsx, svm_names)
+        if len(included) < len(svm_names):
+            #an empty include list still needs a query that matches nothing
+            query["svm.name"] = "|".join(included) if included else "!*"
+    volume_excludes = [rule["volume"] for rule in fsx["rules"] if rule.get("exclude") and rule.get("svm", "*") == "*" and "volume" in rule]
+    if fsx["include_volumes"]:
+        if all(isOntapPattern(pattern) for pattern in fsx["include_volumes"]):
+            query[volume_field] = "|".join(fsx["include_volumes"])
+    elif len(volume_excludes) == 1 and isOntapPattern(volume_excludes[0]):
+        #ONTAP queries cannot AND several negations, other exclusions are applied on the listing
+        query[volume_field] = "!" + volume_excludes[0]
+    return query
@@ -0,0 +1,110 @@
+# Copyright NetApp 2023. Developed by NetApp Solutions Engineering Team
+#
+# Description:  Columnar table of the LUN and volume inventory for the decision phase of the
+#               FSx ONTAP monitoring Lambda function. Utilization, warning/resize classification,
+#               target sizes and space rollups are computed for all objects of a file system at once.
+#               Columns are array.array buffers, NumPy is used on top of them when it is available.
+import math
+from array import array
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+STATUS_OK = 0
+STATUS_WARN = 1
+STATUS_RESIZE = 2
+#utilization above which a notification is sent when warn_notification is set
+WARN_PERCENT = 75
+
+def newTable(objects, policies=None, group_key=None):
+    #objects are LUN or volume dicts, thick provisioned objects consume their full size
+    table = {
+        "size": array('d', (float(obj['space_total']) for obj in objects)),
+        "used": array('d', (float(obj['space_used']) for obj in objects)),
+        "thick": array('b', (obj.get('space_reserved') is True or obj.get('guarantee') == "volume" for obj in objects)),
+        "group": array('l'),
+        "groups": []
+    }
+    if group_key:
+        #parent volume or aggregate of each row as an index into groups
+        group_index = {}
+        for obj in objects:
+            if obj[group_key] not in group_index:
+                group_index[obj[group_key]] = len(table['groups'])
+                table['groups'].append(obj[group_key])
+            table['group'].append(group_index[obj[group_key]])
+    if policies is not None:
+        table['threshold'] = array('d', (float(policy['resize_threshold']) for policy in policies))
+        table['growth'] = array('d', (1 + float(policy['growth_percent'])/100 for policy in policies))
+        table['warn'] = array('b', (bool(policy['warn_notification']) for policy in policies))
+    return table
+
+def getColumns(table, *names):
+    #zero-copy NumPy views of the array columns
+    return [numpy.frombuffer(table[name], dtype=table[name].typecode) if len(table[name]) else numpy.zeros(0) for name in names]
+
+def classify(table):
+    #returns utilization percent, risk (distance to the resize threshold) and status of every row
+    if numpy is not None:
+        size, used, threshold, warn = getColumns(table, "size", "used", "threshold", "warn")
+        per = numpy.divide(used * 100, size, out=numpy.zeros(len(size)), where=size > 0)
+        risk = per - threshold
+        status = numpy.where(per > threshold, STATUS_RESIZE, numpy.where((warn != 0) & (per > WARN_PERCENT) & (per < threshold), STATUS_WARN, STATUS_OK))
+        return per, risk, status
+    per = array('d', ((used * 100 / size) if size > 0 else 0.0 for size, used in zip(table['size'], table['used'])))
+    risk = array('d', (p - threshold for p, threshold in zip(per, table['threshold'])))
+    status = array('b')
+    for p, threshold, warn in zip(per, table['threshold'], table['warn']):
+        if p > threshold:
+            status.append(STATUS_RESIZE)
+        elif warn and p > WARN_PERCENT and p < threshold:
+            status.append(STATUS_WARN)
+        else:
+            status.append(STATUS_OK)
+    return per, risk, status
+
+def getTargetSizes(table, status):
+    #size grown by whole policy growth steps until utilization is below the resize threshold, 0 when no resize is needed
+    if numpy is not None:
+        size, used, threshold, growth = getColumns(table, "size", "used", "threshold", "growth")
+        resize = (numpy.asarray(status) == STATUS_RESIZE) & (size > 0)
+        targets = numpy.zeros(len(size))
+        if not resize.any():
+            return targets
+        size, used, threshold, growth = size[resize], used[resize], threshold[resize], growth[resize]
+        steps = numpy.maximum(1, numpy.ceil(numpy.log(used * 100 / (threshold * size)) / numpy.log(growth)))
+        #floating point at the threshold boundary, match growing one step at a time
+        steps += (used * 100 / (size * growth ** steps)) > threshold
+        steps -= (steps > 1) & ((used * 100 / (size * growth ** (steps - 1))) <= threshold)
+        targets[resize] = size * growth ** steps
+        return targets
+    targets = array('d', bytes(8 * len(table['size'])))
+    for i, row_status in enumerate(status):
+        if row_status == STATUS_RESIZE and table['size'][i] > 0:
+            targets[i] = getTargetSize(table['size'][i], table['used'][i], table['threshold'][i], table['growth'][i])
+    return targets
+
+def getTargetSize(size, used, threshold, growth):
+    new_size = size * growth
+    while used * 100 / new_size > threshold:
+        new_size *= growth
+    return new_size
+
+def getConsumedSpace(table):
+    #thick provisioned rows consume their size, thin provisioned rows their used space
+    if numpy is not None:
+        size, used, thick = getColumns(table, "size", "used", "thick")
+        return float(numpy.where(thick != 0, size, used).sum())
+    return math.fsum(size if thick else used for size, used, thick in zip(table['size'], table['used'], table['thick']))
+
+def getConsumedSpaceByGroup(table):
+    #consumed space rolled up per parent volume or aggregate
+    if numpy is not None:
+        size, used, thick, group = getColumns(table, "size", "used", "thick", "group")
+        totals = numpy.bincount(group.astype(numpy.intp), weights=numpy.where(thick != 0, size, used), minlength=len(table['groups']))
+        return dict(zip(table['groups'], totals.tolist()))
+    totals = [0.0] * len(table['groups'])
+    for size, used, thick, group in zip(table['size'], table['used'], table['thick'], table['group']):
+        totals[group] += size if thick else used
+    return dict(zip(table['groups'], totals))
@@ -15,760 +15,1954 @@
 #   - Save the password for fsxadmin in SSM parameter Store and provide the path in fsx_password_ssm_parameter variable in vars.py
 #   - Set "warn_notification" variable to True to receive email alerts when a LUN, vol or Storage Capacity crosses 75%.
 #   - Set "snapshot_age_threshold_in_days" to the number of days to delete snapshots older than the number of days set 
+#   - Set "checkpoint_s3_bucket" to persist unfinished work across invocations when the Lambda timeout is reached
 import json
 import requests
 requests.packages.urllib3.disable_warnings() 
 import base64
+import codecs
 import logging
 import vars
+import fleet_config
+import fleet_table
 import math
 import time
+import threading
+import os
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 import boto3
 import botocore
 import re
+import urllib.parse
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor, Future
+
+class OntapSession(requests.Session):
+    #GET responses fetched with getCached are shared for the rest of the run, PATCH and DELETE invalidate them
+    def __init__(self):
+        super().__init__()
+        self.cache = {}
+        self.cache_lock = threading.Lock()
+        self.cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def request(self, method, url, *args, **kwargs):
+        try:
+            return super().request(method, url, *args, **kwargs)
+        finally:
+            if method.upper() in ["PATCH", "DELETE", "POST"]:
+                self.invalidate(url)
+
+    def getCached(self, url, headers, params=None):
+        #keyed by resource, query and fields. Concurrent identical requests wait for the first one
+        if not vars.ontap_response_cache:
+            return self.get(url, headers=headers, params=params, verify=False)
+        key = (url, tuple(sorted((params or {}).items())), headers.get('authorization'))
+        with self.cache_lock:
+            entry = self.cache.get(key)
+            if entry is not None:
+                self.cache_stats['hits'] += 1
+                owner = False
+            else:
+                entry = self.cache[key] = Future()
+                self.cache_stats['misses'] += 1
+                owner = True
+        if not owner:
+            return entry.result()
+        try:
+            response = self.get(url, headers=headers, params=params, verify=False)
+        except Exception as e:
+            self.discard(key, entry)
+            entry.set_exception(e)
+            raise
+        #failed responses are returned to the waiting callers but not kept
+        if response.status_code not in range(200, 300):
+            self.discard(key, entry)
+        entry.set_result(response)
+        return response
+
+    def discard(self, key, entry):
+        with self.cache_lock:
+            if self.cache.get(key) is entry:
+                del self.cache[key]
+
+    def invalidate(self, url):
+        #a write to a resource makes the cached resource, its collection and its sub-resources stale
+        written = urllib.parse.urlsplit(url)
+        with self.cache_lock:
+            for key in list(self.cache):
+                cached = urllib.parse.urlsplit(key[0])
+                if cached.netloc == written.netloc and (isSubPath(cached.path, written.path) or isSubPath(written.path, cached.path)):
+                    del self.cache[key]
+                    self.cache_stats['invalidations'] += 1
+
+    def clearCache(self, fsxMgmtIp):
+        with self.cache_lock:
+            for key in list(self.cache):
+                if urllib.parse.urlsplit(key[0]).netloc == fsxMgmtIp:
+                    del self.cache[key]
+
+    def getCacheStats(self):
+        with self.cache_lock:
+            return dict(self.cache_stats)
+
+def isSubPath(path, parent):
+    return path == parent or path.startswith(parent.rstrip("/") + "/")
+
+#connections to the management endpoints are kept alive across calls and warm invocations
+ontap_session = OntapSession()
+ontap_session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=max(10, vars.inventory_max_workers_per_fsx)))
 def lambda_handler(event, context):
-    
-    #retrieve fsxn password
-    ssm = boto3.client('ssm')
+    #the long-running service in fsxn_monitoring_service.py runs the same cycle with warm clients
+    if isProfilingRequested(event):
+        return runProfiled(event, context)
+    return runMonitoringCycle(event, context, getAwsClients())
+
+def isProfilingRequested(event):
+    #{"profile": true} in the event or FSXN_MONITORING_PROFILE=true in the function environment
+    if isinstance(event, dict) and event.get('profile') is True:
+        return True
+    return os.environ.get('FSXN_MONITORING_PROFILE', "").lower() in ["1", "true", "yes"]
+
+def runProfiled(event, context):
+    #profiling modules are only loaded when a profile is requested
+    import cProfile
+    import pstats
+    import tracemalloc
+    import io
+    import sys
+    run_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    if getattr(context, 'aws_request_id', None):
+        run_id += "-" + context.aws_request_id
+    logger.info("Profiling run %s", run_id)
+
+    #worker threads of the inventory get their own profiler, python 3.12 and later profile every thread from the main one
+    profilers = [cProfile.Profile()]
+    def profileThread(*args):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            #another profiler is active, remove the hook so that it is not called on every event of the thread
+            sys.setprofile(None)
+            return
+        profilers.append(profiler)
+    tracemalloc.start(vars.profile_traceback_frames)
+    if sys.version_info < (3, 12):
+        threading.setprofile(profileThread)
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    profilers[0].enable()
+    try:
+        return runMonitoringCycle(event, context, getAwsClients())
+    finally:
+        profilers[0].disable()
+        if sys.version_info < (3, 12):
+            threading.setprofile(None)
+        wall_time = time.perf_counter() - wall_start
+        cpu_time = time.process_time() - cpu_start
+        allocations = tracemalloc.take_snapshot().statistics('lineno')[:vars.profile_top_n]
+        current_memory, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        stats_output = io.StringIO()
+        stats = pstats.Stats(*profilers, stream=stats_output)
+        stats.sort_stats("cumulative").print_stats(vars.profile_top_n)
+        summary = [
+            "Profile {}: wall time {:.2f} s, CPU time {:.2f} s, peak traced memory {:.1f} MiB, memory still allocated {:.1f} MiB".format(
+                run_id, wall_time, cpu_time, peak_memory/(1024*1024), current_memory/(1024*1024)),
+            "Top allocation sites:"
+        ]
+        summary += ["  {:.1f} KiB in {} blocks at {}".format(allocation.size/1024, allocation.count, allocation.traceback[0]) for allocation in allocations]
+        report = "\n".join(summary) + "\n\n" + stats_output.getvalue()
+        for line in summary[:6]:
+            logger.info(line)
+
+        files = {}
+        try:
+            files['prof'] = os.path.join(vars.profile_local_dir, "fsxn_profile_{}.prof".format(run_id))
+            stats.dump_stats(files['prof'])
+            files['txt'] = os.path.join(vars.profile_local_dir, "fsxn_profile_{}.txt".format(run_id))
+            with open(files['txt'], "w") as f:
+                f.write(report)
+            logger.info("Profile written to %s", ", ".join(files.values()))
+        except OSError as e:
+            logger.error("Failed to write profile: %s", e)
+        if vars.profile_s3_bucket:
+            client_s3 = boto3.client('s3')
+            for path in files.values():
+                try:
+                    with open(path, "rb") as f:
+                        client_s3.put_object(Bucket=vars.profile_s3_bucket, Key=vars.profile_s3_prefix + os.path.basename(path), Body=f.read())
+                except (botocore.exceptions.ClientError, OSError) as e:
+                    logger.error("Failed to upload profile %s: %s", path, e)
+
+def getAwsClients(session=None, expiration=None):
+    #clients and decrypted passwords reused for a whole monitoring cycle
+    session = session or boto3.Session()
+    return {
+        "session": session,
+        "ssm": session.client('ssm'),
+        "fsx": session.client('fsx'),
+        "passwords": {},
+        "expiration": expiration
+    }
+
+#clients of assumed roles and other regions, kept until their credentials expire
+account_clients = {}
+account_clients_lock = threading.Lock()
+
+#last complete scan of every object per file system, filtered scans take the storage capacity totals from it
+full_scans = {}
+
+def getFleetGroups(fsx_list):
+    #file systems sharing a role and region, in fleet order
+    groups = {}
+    for fsx in fsx_list:
+        groups.setdefault((fsx.get('role_arn') or "", fsx.get('region') or ""), []).append(fsx)
+    return list(groups.values())
+
+def getAccountClients(clients, role_arn, region):
+    #file systems without a role or region use the default credentials of the cycle
+    if not role_arn and not region:
+        return clients
+    key = (role_arn, region)
+    with account_clients_lock:
+        cached = account_clients.get(key)
+    if cached and (cached['expiration'] is None or cached['expiration'] - datetime.now(timezone.utc) > timedelta(seconds=vars.assume_role_refresh_margin_in_seconds)):
+        return cached
+
+    if role_arn:
+        logger.info("Assuming role %s for region %s", role_arn, region or "default")
+        sts = boto3.Session().client('sts', region_name=region or None)
+        credentials = sts.assume_role(RoleArn=role_arn, RoleSessionName=vars.assume_role_session_name, DurationSeconds=vars.assume_role_duration_in_seconds)['Credentials']
+        session = boto3.Session(
+            aws_access_key_id=credentials['AccessKeyId'],
+            aws_secret_access_key=credentials['SecretAccessKey'],
+            aws_session_token=credentials['SessionToken'],
+            region_name=region or None
+        )
+        cached = getAwsClients(session, credentials['Expiration'])
+    else:
+        cached = getAwsClients(boto3.Session(region_name=region))
+    with account_clients_lock:
+        account_clients[key] = cached
+    return cached
+
+def getGroupInventory(clients, fsx_list, context, target):
+    #returns the states, deferred inventory keys and failed file system ids of file systems sharing a role and region
+    fsx_states = []
+    deferred_items = []
+    failed = []
+    try:
+        group_clients = getAccountClients(clients, fsx_list[0].get('role_arn'), fsx_list[0].get('region'))
+    except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+        logger.error("Skipping %s, failed to assume role %s: %s", ", ".join(fsx['fsxId'] for fsx in fsx_list), fsx_list[0].get('role_arn'), e)
+        return fsx_states, [workItemKey(fsx['fsxId'], "inventory", "") for fsx in fsx_list], [fsx['fsxId'] for fsx in fsx_list]
+
+    #screen the fleet with CloudWatch metrics so only objects near the thresholds are fetched from ONTAP
+    prescreen = {}
+    if vars.enable_metrics_prescreen and not target:
+        try:
+            prescreen = getMetricsPrescreen(fsx_list, group_clients['fsx'], getMetricsClient(group_clients))
+        except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+            logger.error("Metrics pre-screen disabled: %s", e)
+
+    for fsx in fsx_list:
+        if deadlineReached(context):
+            logger.info("Deadline approaching. Deferring inventory of %s", fsx['fsxId'])
+            deferred_items.append(workItemKey(fsx['fsxId'], "inventory", ""))
+            continue
+        try:
+            state = getFsxInventory(group_clients, fsx, context, target, prescreen.get(fsx['fsxId']))
+        except Exception as e:
+            logger.error("Error occurred while fetching inventory for %s: %s", fsx['fsxId'], e)
+            deferred_items.append(workItemKey(fsx['fsxId'], "inventory", ""))
+            failed.append(fsx['fsxId'])
+            continue
+        if state is None:
+            failed.append(fsx['fsxId'])
+            continue
+        if not state['complete']:
+            deferred_items.append(workItemKey(fsx['fsxId'], "inventory", ""))
+        fsx_states.append(state)
+    return fsx_states, deferred_items, failed
+
+def getGroupInventoryOrDefer(clients, fsx_list, context, target):
+    #a group that fails is deferred as a whole instead of aborting the inventory of the other groups
+    try:
+        return getGroupInventory(clients, fsx_list, context, target)
+    except Exception as e:
+        logger.error("Error occurred while fetching inventory for %s: %s", ", ".join(fsx['fsxId'] for fsx in fsx_list), e)
+        return [], [workItemKey(fsx['fsxId'], "inventory", "") for fsx in fsx_list], [fsx['fsxId'] for fsx in fsx_list]
+
+def runMonitoringCycle(event, context, clients, fsx_configs=None, notified=None, checkpoint_name=""):
+    ssm = clients['ssm']
     email_requirements = []
     clone_vol_details = []
+    deferred_items = []
+    failed_fsx = []
+    errors = []
+
+    #an alarm or direct event names a single filesystem/volume/LUN to remediate instead of a full sweep
+    target = parseEventTarget(event)
+    if target is not None and not target['fsxId']:
+        return {
+            'statusCode': 200,
+            'body': "no action"
+        }
+
+    #validate the fleet configuration and compile its policy rules
+    try:
+        if fsx_configs is None:
+            fsx_configs = getFleetConfig(ssm)
+    except (ValueError, OSError, botocore.exceptions.ClientError) as e:
+        logger.error("Failed to load the fleet configuration: %s", e)
+        return {
+            'statusCode': 400,
+            'body': "Invalid fleet configuration"
+        }
+
+    cache_stats = ontap_session.getCacheStats()
+
+    #load the work left over by the previous invocation, if any
+    checkpoint = {} if target else loadCheckpoint(checkpoint_name)
+    #number of runs each unfinished work item has been deferred for, older checkpoints only list the items
+    deferrals = checkpoint.get('deferrals') or {key: 1 for key in checkpoint.get('pending', [])}
+    resume_keys = set(deferrals)
+    for fsxId, full_scan in checkpoint.get('full_scans', {}).items():
+        if fsxId not in full_scans or full_scans[fsxId]['scanned_at'] < full_scan['scanned_at']:
+            full_scans[fsxId] = full_scan
+    if resume_keys:
+        logger.info("Resuming %d unfinished work items from previous invocation", len(resume_keys))
+
+    try:
+        #inventory filesystems left unfinished by the previous invocation first
+        fsx_list = sorted(fsx_configs, key=lambda fsx: workItemKey(fsx['fsxId'], "inventory", "") not in resume_keys)
+        if target:
+            fsx_list = [fsx for fsx in fsx_list if fsx['fsxId'] == target['fsxId']]
+            if not fsx_list:
+                logger.error("File system %s from the event is not configured", target['fsxId'])
+
+        #file systems of other accounts or regions are inventoried in parallel with their own clients
+        fsx_states = []
+        fleet_groups = getFleetGroups(fsx_list)
+        with ThreadPoolExecutor(max_workers=max(1, min(len(fleet_groups), vars.max_parallel_account_groups))) as pool:
+            for group_states, group_deferred, group_failed in pool.map(lambda group: getGroupInventoryOrDefer(clients, group, context, target), fleet_groups):
+                fsx_states += group_states
+                deferred_items += group_deferred
+                failed_fsx += group_failed
+
+        #process the riskiest work first and stop starting new work before the deadline
+        work_items = buildWorkItems(fsx_states, deferrals)
+        snapshot_pool = ThreadPoolExecutor(max_workers=vars.inventory_max_workers_per_fsx)
+        try:
+            for i in range(len(work_items)):
+                if deadlineReached(context):
+                    logger.info("Deadline approaching. Deferring %d remaining work items", len(work_items) - i)
+                    deferred_items += [item['key'] for item in work_items[i:]]
+                    break
+                #snapshot items come after all capacity work, their listings run ahead of the deletions
+                if work_items[i]['type'] == "snapshot" and (i == 0 or work_items[i-1]['type'] != "snapshot"):
+                    prefetchExpiredSnapshots(work_items[i:], context, snapshot_pool)
+                #work cut short by the deadline is resumed on the next run
+                if not runWorkItem(work_items[i], email_requirements):
+                    deferred_items.append(work_items[i]['key'])
+        finally:
+            snapshot_pool.shutdown(cancel_futures=True)
+
+        #wait for the bulk snapshot deletion jobs of all volumes together
+        for state in fsx_states:
+            waitForSnapshotJobs(state, context, email_requirements)
+
+        #populate flexclone details
+        logger.info("Populating flexclone details")
+        for state in fsx_states:
+            for vol in getCloneVolumes(state):
+                for snapshot in state['snapshot_details']:
+                    if(vol["parent_snapshot"] == snapshot["name"]):
+                        clone_vol_details.append(
+                            {
+                                "name": snapshot["vol_name"],
+                                "parent_snapshot": vol["parent_snapshot"],
+                                "snapshot_size": float(snapshot["size_in_bytes"])/1024
+                            }
+                        )
+    except Exception as e:
+        logger.error("Error occurred while processing the FSx fleet: %s", e)
+        errors.append("Error occurred while processing the FSx fleet: {}".format(e))
+    finally:
+        #counters are shared by concurrent service scans, the difference is an estimate for this run
+        run_stats = {key: value - cache_stats[key] for key, value in ontap_session.getCacheStats().items()}
+        logger.info("ONTAP response cache: %d hits, %d misses, %d invalidations", run_stats['hits'], run_stats['misses'], run_stats['invalidations'])
+        #persist unfinished work and send the consolidated email
+        if not target:
+            fsx_ids = set(fsx['fsxId'] for fsx in fsx_configs)
+            saveCheckpoint(deferred_items, {key: deferrals.get(key, 0) + 1 for key in deferred_items}, {fsxId: full_scan for fsxId, full_scan in list(full_scans.items()) if fsxId in fsx_ids}, checkpoint_name)
+        if deferred_items:
+            email_requirements.append(
+                {
+                    "case": "deferred",
+                    "name": "null",
+                    "use_per": 0,
+                    "new_size": len(deferred_items),
+                    "warn": True
+                }
+            )
+        #the service passes the notifications of the previous scan so that unchanged warnings are not resent
+        if notified is None or not isRepeatedNotification(email_requirements, clone_vol_details, notified):
+            sendEmail(email_requirements, clone_vol_details)
+
+    #file systems that could not be checked fail the run so that callers such as the service health can tell
+    if failed_fsx:
+        errors.insert(0, "Failed to fetch the inventory of {}".format(", ".join(failed_fsx)))
+    if errors:
+        return {
+            'statusCode': 500,
+            'body': ". ".join(errors)
+        }
+    return {
+        'statusCode': 200,
+        'body': "success"
+    }
+
+def getFleetConfig(ssm):
+    #the structured fleet configuration takes precedence over vars.fsxList
+    if vars.fleet_config_source:
+        return fleet_config.loadFleetConfig(vars.fleet_config_source, ssm)
+    return fleet_config.getLegacyFleetConfig(vars.fsxList)
+
+def getObjectPolicy(state, svm, vol_name):
+    return state['fsx']['policy_matcher'](svm, vol_name)
+
+def deadlineReached(context):
+    #lambda context is absent when invoked locally
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return False
+    return context.get_remaining_time_in_millis() < vars.deadline_safety_margin_in_seconds * 1000
+
+def workItemKey(fsxId, item_type, uuid):
+    return "{}:{}:{}".format(fsxId, item_type, uuid)
+
+def getCheckpointLocation(name):
+    #returns the S3 key and local path of a named checkpoint, the service keeps one per file system
+    if not name:
+        return vars.checkpoint_s3_key, vars.checkpoint_local_path
+    s3_root, s3_ext = os.path.splitext(vars.checkpoint_s3_key)
+    local_root, local_ext = os.path.splitext(vars.checkpoint_local_path)
+    return "{}-{}{}".format(s3_root, name, s3_ext), "{}-{}{}".format(local_root, name, local_ext)
+
+def loadCheckpoint(name=""):
+    logger.info("Loading checkpoint")
+    s3_key, local_path = getCheckpointLocation(name)
+    try:
+        if vars.checkpoint_s3_bucket:
+            client_s3 = boto3.client('s3')
+            response = client_s3.get_object(Bucket=vars.checkpoint_s3_bucket, Key=s3_key)
+            return json.loads(response['Body'].read())
+        with open(local_path) as f:
+            return json.load(f)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ["NoSuchKey", "404"]:
+            logger.error("Failed to load checkpoint: %s", e.response['Error']['Message'])
+    except (OSError, ValueError):
+        pass
+    return {}
+
+def saveCheckpoint(pending, deferrals, fsx_full_scans, name=""):
+    logger.info("Saving checkpoint with %d unfinished work items", len(pending))
+    s3_key, local_path = getCheckpointLocation(name)
+    body = json.dumps({"saved_at": datetime.now(timezone.utc).isoformat(), "pending": pending, "deferrals": deferrals, "full_scans": fsx_full_scans})
+    try:
+        if vars.checkpoint_s3_bucket:
+            client_s3 = boto3.client('s3')
+            client_s3.put_object(Bucket=vars.checkpoint_s3_bucket, Key=s3_key, Body=body.encode("utf-8"))
+        else:
+            with open(local_path, "w") as f:
+                f.write(body)
+    except botocore.exceptions.ClientError as e:
+        logger.error("Failed to save checkpoint: %s", e.response['Error']['Message'])
+    except OSError as e:
+        logger.error("Failed to save checkpoint: %s", e)
+
+def getOntapHeaders(username, password):
+    auth_str = str(username) + ":" + str(password)
+    auth_encoded = auth_str.encode("ascii")
+    auth_encoded = base64.b64encode(auth_encoded)
+    auth_encoded = auth_encoded.decode("utf-8")
+    return {
+        'authorization': 'Basic {}'.format(auth_encoded),
+        'content-type': "application/json",
+        'accept': "application/json"
+    }
 
-    for fsxs in range(len(vars.fsxList)):
+#fields projected from the collection listings, in the order of the yielded tuples
+VOL_FIELDS = ["uuid", "name", "svm.name", "space.size", "space.available", "guarantee.type", "clone.is_flexclone", "clone.parent_snapshot.name"]
+LUN_FIELDS = ["uuid", "location.logical_unit", "svm.name", "location.volume.name", "location.volume.uuid", "space.size", "space.used", "space.guarantee.reserved"]
+SNAPSHOT_FIELDS = ["uuid", "name", "create_time", "size"]
+RECORDS_START = re.compile(r'"records"\s*:\s*\[')
+RECORD_SEPARATOR = re.compile(r'[\s,]*')
+json_decoder = json.JSONDecoder()
 
+def iterOntapRecords(headers, fsxMgmtIp, path, fields, params=None):
+    #yields the projected fields of each record of a paginated collection as a tuple, one record in memory at a time
+    field_paths = [field.split(".") for field in fields]
+    params = dict(params or {})
+    params['fields'] = ",".join(fields)
+    params['max_records'] = vars.ontap_page_size
+    url = "https://{}{}".format(fsxMgmtIp, path)
+    while url:
+        response = ontap_session.get(url, headers=headers, params=params, verify=False, stream=True)
+        metadata = {}
         try:
-            ssm_response = ssm.get_parameter(Name=vars.fsxList[fsxs]['fsx_password_ssm_parameter'], WithDecryption=True)
-            fsxn_password = ssm_response['Parameter']['Value']
+            if response.status_code not in range(200, 300):
+                raise Exception("Failed to list {}. Status code: {}, Response: {}".format(path, response.status_code, response.text))
+            for record in iterResponseRecords(response, metadata):
+                yield tuple(getRecordField(record, field_path) for field_path in field_paths)
+        finally:
+            response.close()
+        #the next link already carries the query of the first page
+        next_href = metadata.get('_links', {}).get('next', {}).get('href')
+        url = "https://{}{}".format(fsxMgmtIp, next_href) if next_href else None
+        params = None
+
+def iterResponseRecords(response, metadata):
+    #incrementally decodes {..., "records": [...], ...} yielding one record at a time, the other keys go to metadata
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    chunks = response.iter_content(chunk_size=vars.ontap_stream_chunk_size)
+    buffer = ""
+    pos = 0
+    head = None
+    eof = False
+    while True:
+        if head is None:
+            match = RECORDS_START.search(buffer)
+            if match:
+                head = buffer[:match.start()]
+                pos = match.end()
+                continue
+            if eof:
+                #error responses and empty bodies have no records
+                metadata.update(json.loads(buffer or "{}"))
+                return
+        else:
+            pos = RECORD_SEPARATOR.match(buffer, pos).end()
+            if pos < len(buffer) and buffer[pos] == "]":
+                break
+            if pos < len(buffer):
+                try:
+                    record, pos = json_decoder.raw_decode(buffer, pos)
+                except ValueError:
+                    #record is split across chunks
+                    if eof:
+                        raise
+                else:
+                    yield record
+                    continue
+            elif eof:
+                raise ValueError("Unexpected end of ONTAP collection response")
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+            buffer = buffer[pos:] + decoder.decode(b"", final=True)
+        else:
+            buffer = buffer[pos:] + decoder.decode(chunk)
+        pos = 0
+
+    #metadata around the records array is small, rebuild it as two objects
+    tail = buffer[pos+1:] + "".join(decoder.decode(chunk) for chunk in chunks) + decoder.decode(b"", final=True)
+    metadata.update(json.loads(head.strip().rstrip(",") + "}"))
+    metadata.update(json.loads("{" + tail.strip().lstrip(",")))
+
+def getRecordField(record, field_path):
+    for key in field_path:
+        if not isinstance(record, dict) or key not in record:
+            return None
+        record = record[key]
+    return record
+
+def getVolFromRecord(values):
+    uuid, name, svm, size, available, guarantee, is_flexclone, parent_snapshot = values
+    return {
+        "name": name,
+        "uuid": uuid,
+        "svm": svm,
+        "space_total": size,
+        "space_used": size - available,
+        "guarantee": guarantee,
+        "is_flexclone": bool(is_flexclone),
+        "parent_snapshot": parent_snapshot or ""
+    }
+
+def getLunFromRecord(values):
+    uuid, name, svm, vol_name, vol_uuid, size, used, reserved = values
+    return {
+        "name": name,
+        "uuid": uuid,
+        "svm": svm,
+        "vol_name": vol_name,
+        "vol_uuid": vol_uuid,
+        "space_total": size,
+        "space_used": used,
+        "space_reserved": reserved
+    }
+
+def parseEventTarget(event):
+    #returns {fsxId, volume_uuid, volume_id, lun_uuid} for targeted events or None for a full sweep
+    if not isinstance(event, dict):
+        return None
+
+    #direct invocation: {"fsxId": "fs-...", "volume_uuid": "..."}
+    if event.get('fsxId'):
+        return {
+            "fsxId": event['fsxId'],
+            "volume_uuid": event.get('volume_uuid', ""),
+            "volume_id": event.get('volume_id', ""),
+            "lun_uuid": event.get('lun_uuid', "")
+        }
+
+    #CloudWatch alarm delivered through SNS
+    if event.get('Records') and 'Sns' in event['Records'][0]:
+        try:
+            message = json.loads(event['Records'][0]['Sns']['Message'])
+        except (ValueError, TypeError):
+            logger.error("Unable to parse SNS message from the event")
+            return None
+        dimensions = {d['name']: d['value'] for d in message.get('Trigger', {}).get('Dimensions', [])}
+        return getTargetFromDimensions(dimensions)
+
+    #CloudWatch alarm through EventBridge ("detail") or a lambda alarm action ("alarmData")
+    alarm = event.get('detail') if event.get('source') == "aws.cloudwatch" and 'detail' in event else event.get('alarmData')
+    if alarm:
+        if alarm.get('state', {}).get('value', "ALARM") != "ALARM":
+            logger.info("Alarm %s is not in ALARM state. Nothing to remediate", alarm.get('alarmName'))
+            return {"fsxId": "", "volume_uuid": "", "volume_id": "", "lun_uuid": ""}
+        for metric in alarm.get('configuration', {}).get('metrics', []):
+            dimensions = metric.get('metricStat', {}).get('metric', {}).get('dimensions', {})
+            if dimensions.get('FileSystemId'):
+                return getTargetFromDimensions(dimensions)
+        logger.error("No FileSystemId dimension found in alarm %s", alarm.get('alarmName'))
+        return {"fsxId": "", "volume_uuid": "", "volume_id": "", "lun_uuid": ""}
+
+    #scheduled EventBridge rule or empty test event
+    return None
+
+def getTargetFromDimensions(dimensions):
+    return {
+        "fsxId": dimensions.get('FileSystemId', ""),
+        "volume_uuid": "",
+        "volume_id": dimensions.get('VolumeId', ""),
+        "lun_uuid": ""
+    }
+
+def getFsxInventory(clients, fsx, context, target=None, screen=None):
+    logger.info("Fetching inventory for %s", fsx['fsxId'])
+    #responses cached by the previous run of this file system are stale
+    ontap_session.clearCache(fsx['fsxMgmtIp'])
+    fsxn_password = getFsxPassword(clients, fsx['fsx_password_ssm_parameter'])
+    if fsxn_password is None:
+        return None
+
+    client_fsx = clients['fsx']
+    headers = getOntapHeaders(fsx['username'], fsxn_password)
+    state = {
+        "fsx": fsx,
+        "client_fsx": client_fsx,
+        "context": context,
+        "headers": headers,
+        "storage_capacity": None,
+        "aggr_total": None,
+        "lun_details": [],
+        "vol_details": [],
+        "snapshot_details": [],
+        "clone_details": [],
+        "snapshot_vols": [],
+        "snapshot_jobs": [],
+        "expired_snapshots": {},
+        "reclaimed_snapshots": set(),
+        "sc_vols": None,
+        "sc_space_used": None,
+        "autosize_vols": None,
+        "autosize_drift": [],
+        "complete": True,
+        "targeted": False,
+        "filtered": False
+    }
+
+    #independent reads run concurrently, the pool size caps the load on the management endpoint
+    with ThreadPoolExecutor(max_workers=vars.inventory_max_workers_per_fsx) as pool:
+        storage_capacity = pool.submit(getStorageCapacity, client_fsx, str(fsx['fsxId']))
+        aggr_total = pool.submit(getAggrTotal, headers, fsx['fsxMgmtIp'])
+        autosize_vols = None
+        if vars.enable_autosize_reconciliation and not (target and (target['volume_uuid'] or target['volume_id'] or target['lun_uuid'])):
+            autosize_vols = pool.submit(getAutosizeSettings, headers, fsx['fsxMgmtIp'])
+        if target and (target['volume_uuid'] or target['volume_id'] or target['lun_uuid']):
+            getTargetedInventory(state, target)
+        elif screen and not screen['fs_near']:
+            getScreenedInventory(state, screen, pool)
+        elif vars.enable_utilization_filter and not isFullScanDue(fsx):
+            getFilteredInventory(state, pool)
+        else:
+            getPartitionedInventory(state, context, pool)
+            if state['complete']:
+                recordFullScan(state)
+        if autosize_vols:
+            try:
+                state['autosize_vols'] = autosize_vols.result()
+            except Exception as e:
+                logger.error("Failed to list the autosize settings of %s: %s", fsx['fsxId'], e)
+        state['storage_capacity'] = storage_capacity.result()
+        state['aggr_total'] = aggr_total.result()
+    return state
+
+def isFullScanDue(fsx):
+    full_scan = full_scans.get(fsx['fsxId'])
+    return full_scan is None or time.time() - full_scan['scanned_at'] >= vars.utilization_filter_full_scan_interval_in_seconds
+
+def recordFullScan(state):
+    #storage capacity totals and the smallest LUN size seed the filtered scans until the next full scan
+    lun_sizes = [float(lun['space_total']) for lun in state['lun_details']]
+    full_scans[state['fsx']['fsxId']] = {
+        "scanned_at": time.time(),
+        "sc_space_used": getScSpaceUsed(getScVolumes(state)),
+        "min_lun_size": min(lun_sizes) if lun_sizes else None
+    }
+
+def getFilteredInventory(state, pool):
+    #ONTAP only returns the volumes and LUNs above the lowest warning floor of the file system
+    fsx = state['fsx']
+    headers = state['headers']
+    full_scan = full_scans[fsx['fsxId']]
+    state['filtered'] = True
+    state['sc_space_used'] = full_scan['sc_space_used']
+    floor = max(0, int(getFleetWarningFloor(fsx) - vars.utilization_filter_margin))
+    svm_names = getSvmNames(headers, fsx['fsxMgmtIp']) if fsx['include_svms'] or fsx['exclude_svms'] else []
+    policy_matcher = fsx['policy_matcher'] if fleet_config.hasFilters(fsx) else None
+    clone_details = pool.submit(getCloneDetails, headers, fsx['fsxMgmtIp'])
+
+    #queries cannot compare two fields, no LUN of at least the smallest size is near the floor below this much used space
+    luns = None
+    if full_scan['min_lun_size'] is not None:
+        lun_query = dict(fleet_config.getOntapFilterQuery(fsx, svm_names, "location."), **{"space.used": ">={}".format(int(full_scan['min_lun_size'] * floor / 100))})
+        luns = pool.submit(getLunDetails, headers, fsx['fsxMgmtIp'], query=lun_query, policy_matcher=policy_matcher)
+    vol_query = dict(fleet_config.getOntapFilterQuery(fsx, svm_names), **{"space.percent_used": ">={}".format(floor)})
+    state['vol_details'] = getVolDetails(headers, [], fsx['fsxMgmtIp'], query=vol_query, policy_matcher=policy_matcher)
+    if luns:
+        state['lun_details'], _ = luns.result()
+    state['clone_details'] = clone_details.result()
+    logger.info("Utilization filter: %d volumes and %d LUNs of %s are above %d%%. Next full scan in %d seconds", len(state['vol_details']), len(state['lun_details']), fsx['fsxId'], floor,
+                full_scan['scanned_at'] + vars.utilization_filter_full_scan_interval_in_seconds - time.time())
+    return state
+
+def getPartitionedInventory(state, context, pool):
+    #LUNs and volumes are listed per SVM so that large file systems are read in parallel
+    fsx = state['fsx']
+    headers = state['headers']
+    svm_names = fleet_config.getIncludedSvms(fsx, getSvmNames(headers, fsx['fsxMgmtIp']))
+
+    #push include/exclude filters down into the ONTAP queries so excluded objects are never fetched
+    vol_query = fleet_config.getOntapFilterQuery(fsx, svm_names)
+    lun_query = fleet_config.getOntapFilterQuery(fsx, svm_names, "location.")
+    policy_matcher = None
+    sc_vols = None
+    clone_details = None
+    if fleet_config.hasFilters(fsx):
+        policy_matcher = fsx['policy_matcher']
+        #excluded volumes still consume storage capacity and may hold clone parents
+        sc_vols = pool.submit(getVolumeSpaceSummaries, headers, fsx['fsxMgmtIp'])
+        clone_details = pool.submit(getCloneDetails, headers, fsx['fsxMgmtIp'])
+
+    lun_parts = [pool.submit(getLunDetails, headers, fsx['fsxMgmtIp'], context, query=dict(lun_query, **{"svm.name": svm}), policy_matcher=policy_matcher) for svm in svm_names]
+    vol_parts = [pool.submit(getVolDetails, headers, [], fsx['fsxMgmtIp'], context, query=dict(vol_query, **{"svm.name": svm}), policy_matcher=policy_matcher) for svm in svm_names]
+
+    #merge in SVM order before the decision phase
+    lun_complete = True
+    for part in lun_parts:
+        lun_details, complete = part.result()
+        state['lun_details'] += lun_details
+        lun_complete = lun_complete and complete
+    for part in vol_parts:
+        state['vol_details'] += part.result()
+    if sc_vols:
+        state['sc_vols'] = sc_vols.result()
+        state['clone_details'] = clone_details.result()
+    state['complete'] = lun_complete and not deadlineReached(context)
+    return state
+
+def prefetchExpiredSnapshots(work_items, context, pool):
+    #list the snapshots of the volumes concurrently in work order, listings not started by the deadline are skipped
+    for item in work_items:
+        state = item['state']
+        vol = item['object']
+        policy = getObjectPolicy(state, vol['svm'], vol['name'])
+        state['expired_snapshots'][vol['uuid']] = pool.submit(getExpiredSnapshots, state, vol, policy, context)
+
+def getFsxPassword(clients, parameter):
+    #retrieve fsxn password, cached in the clients for as long as they are kept
+    if parameter not in clients['passwords']:
+        try:
+            ssm_response = clients['ssm'].get_parameter(Name=parameter, WithDecryption=True)
         except botocore.exceptions.ClientError as e:
             logger.error(e.response['Error']['Message'])
+            return None
+        clients['passwords'][parameter] = ssm_response['Parameter']['Value']
+    return clients['passwords'][parameter]
 
-        vol_details = []
-        lun_details = []
-        snapshot_details = []
-        
-        #initialize boto3 fsx
-        client_fsx = boto3.client('fsx')
-        
-        #get fsx storage capacity
-        storage_capacity = getStorageCapacity(client_fsx, str(vars.fsxList[fsxs]['fsxId']))
-        
-        #initialize ontap api auth
-        auth_str = str(vars.fsxList[fsxs]['username']) + ":" + str(fsxn_password)
-        auth_encoded = auth_str.encode("ascii")
-        auth_encoded = base64.b64encode(auth_encoded)
-        auth_encoded = auth_encoded.decode("utf-8")
-        headers = {
-            'authorization': 'Basic {}'.format(auth_encoded),
-            'content-type': "application/json",
-            'accept': "application/json"
-        }
-        
+def getSvmNames(headers, fsxMgmtIp):
+    return [name for (name,) in iterOntapRecords(headers, fsxMgmtIp, "/api/svm/svms", ["name"])]
+
+def getVolumeSpaceSummaries(headers, fsxMgmtIp):
+    #space of every volume from a single projected collection call, used for storage capacity math
+    sc_vols = []
+    for uuid, name, size, available, guarantee in iterOntapRecords(headers, fsxMgmtIp, "/api/storage/volumes", ["uuid", "name", "space.size", "space.available", "guarantee.type"]):
+        sc_vols.append(
+            {
+                "name": name,
+                "uuid": uuid,
+                "space_total": size,
+                "space_used": size - available,
+                "guarantee": guarantee
+            }
+        )
+    return sc_vols
+
+def getStateScSpaceUsed(state):
+    #a filtered inventory uses the totals of the last full scan unless the volumes were listed since
+    if state['sc_vols'] is None and state['sc_space_used'] is not None:
+        return state['sc_space_used']
+    return getScSpaceUsed(getScVolumes(state))
+
+def getScVolumes(state):
+    if state['sc_vols'] is not None:
+        return state['sc_vols']
+    return state['vol_details']
+
+def getTargetedInventory(state, target):
+    fsx = state['fsx']
+    headers = state['headers']
+    state['targeted'] = True
+    vol_uuid = target['volume_uuid']
+
+    #alarms name the FSx volume id, ONTAP needs the volume uuid
+    if not vol_uuid and target['volume_id']:
         try:
-            # URL for fetching aggregate details
-            url_aggregate = "https://{}/api/storage/aggregates".format(vars.fsxList[fsxs]['fsxMgmtIp'])
+            response = state['client_fsx'].describe_volumes(VolumeIds=[target['volume_id']])
+            vol_uuid = response['Volumes'][0]['OntapConfiguration']['UUID']
+        except (botocore.exceptions.ClientError, IndexError, KeyError) as e:
+            logger.error("Unable to find ONTAP volume for %s: %s", target['volume_id'], e)
+            return state
+
+    if target['lun_uuid']:
+        lun = getLunDetail(headers, fsx['fsxMgmtIp'], target['lun_uuid'])
+        state['lun_details'] = [lun]
+        vol_uuid = lun['vol_uuid']
+        #the volume fit check of a thick LUN needs the space of every LUN in the volume
+        vol_luns, _ = getLunDetails(headers, fsx['fsxMgmtIp'], vol_uuid=vol_uuid)
+        state['lun_space_by_vol'] = fleet_table.getConsumedSpaceByGroup(fleet_table.newTable(vol_luns, group_key="vol_uuid"))
+    else:
+        state['lun_details'], _ = getLunDetails(headers, fsx['fsxMgmtIp'], vol_uuid=vol_uuid)
+
+    logger.info("Fetching details of targeted volume %s", vol_uuid)
+    state['vol_details'] = [getVolDetail(headers, fsx['fsxMgmtIp'], vol_uuid)]
+
+    #snapshot retention of the targeted volume must not delete FlexClone parents of other volumes
+    state['clone_details'] = getCloneDetails(headers, fsx['fsxMgmtIp'])
+    return state
+
+def getScreenedInventory(state, screen, pool):
+    fsx = state['fsx']
+    headers = state['headers']
+    state['targeted'] = True
+
+    #LUN utilization is not published to CloudWatch, a single projected collection call covers all LUNs
+    state['lun_details'] = [lun for lun in getLunSummaries(headers, fsx['fsxMgmtIp']) if not getObjectPolicy(state, lun['svm'], lun['vol_name'])['exclude']]
+
+    #drop volumes excluded by the fleet configuration before fetching anything about them
+    policy_matcher = fsx['policy_matcher']
+    screen_vols = {uuid: vol for uuid, vol in screen['volumes'].items() if not policy_matcher(vol['svm'], vol['name'])['exclude']}
+    near_vols = [uuid for uuid, vol in screen_vols.items() if vol['near']]
+    logger.info("Metrics pre-screen: %d of %d volumes of %s are near the thresholds", len(near_vols), len(screen_vols), fsx['fsxId'])
+    state['vol_details'] = list(pool.map(lambda vol_uuid: getVolDetail(headers, fsx['fsxMgmtIp'], vol_uuid), near_vols))
+
+    #snapshot retention still applies to every volume, clone parents must be known to protect them
+    state['snapshot_vols'] = [{"name": vol['name'], "uuid": uuid, "svm": vol['svm'], "per": vol['per']} for uuid, vol in screen_vols.items() if not vol['near']]
+    if state['snapshot_vols']:
+        state['clone_details'] = getCloneDetails(headers, fsx['fsxMgmtIp'])
+    return state
+
+def getAutosizeSettings(headers, fsxMgmtIp):
+    #autosize settings of every thin provisioned volume from a single projected collection call
+    autosize_vols = []
+    fields = ["uuid", "name", "svm.name", "space.size", "space.available", "autosize.mode", "autosize.maximum", "autosize.grow_threshold"]
+    for uuid, name, svm, size, available, mode, maximum, grow_threshold in iterOntapRecords(headers, fsxMgmtIp, "/api/storage/volumes", fields, {"guarantee.type": "none"}):
+        autosize_vols.append(
+            {
+                "name": name,
+                "uuid": uuid,
+                "svm": svm,
+                "space_total": size,
+                "space_used": size - available,
+                "autosize": {"mode": mode, "maximum": maximum, "grow_threshold": grow_threshold}
+            }
+        )
+    return autosize_vols
+
+def getAutosizeTarget(vol, policy):
+    #autosize grows the volume at the resize threshold up to the policy maximum
+    growth = 1 + float(policy['growth_percent'])/100
+    if policy['max_size_in_gb']:
+        maximum = int(float(policy['max_size_in_gb'])*1024*1024*1024)
+    elif vol['autosize']['maximum'] and vol['autosize']['maximum'] >= vol['space_total'] * growth:
+        #without a policy maximum any maximum leaving room for a growth step is kept
+        maximum = vol['autosize']['maximum']
+    else:
+        maximum = int(vol['space_total'] * vars.autosize_maximum_percent / 100)
+    return {
+        "mode": "grow",
+        "grow_threshold": int(policy['resize_threshold']),
+        "maximum": max(maximum, int(vol['space_total']))
+    }
 
-            # Fetch aggregate details
-            response_aggregate = requests.get(url_aggregate, headers=headers, verify=False)
+def getCloneVolumes(state):
+    clone_vols = [vol for vol in state['vol_details'] if vol['is_flexclone']]
+    vol_uuids = set(vol['uuid'] for vol in clone_vols)
+    return clone_vols + [vol for vol in state['clone_details'] if vol['uuid'] not in vol_uuids]
 
-            if response_aggregate.status_code == 200:
-                # Parse the JSON response
-                aggr_data = response_aggregate.json()
+def getCloneDetails(headers, fsxMgmtIp):
+    logger.info("Fetching FlexClone Details")
+    clone_details = []
+    for uuid, name, parent_snapshot in iterOntapRecords(headers, fsxMgmtIp, "/api/storage/volumes", ["uuid", "name", "clone.parent_snapshot.name"], {"clone.is_flexclone": "true"}):
+        clone_details.append(
+            {
+                "name": name,
+                "uuid": uuid,
+                "is_flexclone": True,
+                "parent_snapshot": parent_snapshot
+            }
+        )
+    return clone_details
+
+def getLunSummaries(headers, fsxMgmtIp):
+    logger.info("Fetching LUN Summaries")
+    return [getLunFromRecord(values) for values in iterOntapRecords(headers, fsxMgmtIp, "/api/storage/luns", LUN_FIELDS)]
+
+def getMetricsClient(clients):
+    #replace to run the pre-screen against a stub locally
+    return clients['session'].client('cloudwatch')
+
+def getMetricsPrescreen(fsx_list, client_fsx, metrics_client):
+    #returns {fsxId: {"fs_near": bool, "volumes": {uuid: {"name", "per", "near"}}}}
+    logger.info("Pre-screening utilization with CloudWatch metrics")
+    prescreen = {}
+    fsx_configs = {}
+    queries = []
+    query_keys = {}
+    for fsx in fsx_list:
+        fsx_configs[fsx['fsxId']] = fsx
+        prescreen[fsx['fsxId']] = {"fs_near": True, "volumes": {}}
+        for metric in ["StorageUsed", "StorageCapacity"]:
+            query_id = "q{}".format(len(queries))
+            query_keys[query_id] = (fsx['fsxId'], "", metric)
+            queries.append(getMetricQuery(query_id, metric, [
+                {'Name': 'FileSystemId', 'Value': fsx['fsxId']},
+                {'Name': 'StorageTier', 'Value': 'SSD'},
+                {'Name': 'DataType', 'Value': 'All'}
+            ] if metric == "StorageUsed" else [
+                {'Name': 'FileSystemId', 'Value': fsx['fsxId']},
+                {'Name': 'StorageTier', 'Value': 'SSD'}
+            ]))
+
+    #list the fsx volumes of the fleet, volume metrics are keyed by the fsx volume id
+    try:
+        paginator_args = {'Filters': [{'Name': 'file-system-id', 'Values': list(prescreen.keys())}]}
+        while True:
+            response = client_fsx.describe_volumes(**paginator_args)
+            for vol in response['Volumes']:
+                if vol['FileSystemId'] not in prescreen or 'OntapConfiguration' not in vol:
+                    continue
+                prescreen[vol['FileSystemId']]['volumes'][vol['OntapConfiguration']['UUID']] = {"name": vol['Name'], "svm": vol['OntapConfiguration'].get('StorageVirtualMachineId', ""), "per": None, "near": True}
+                for metric in ["StorageUsed", "StorageCapacity"]:
+                    query_id = "q{}".format(len(queries))
+                    query_keys[query_id] = (vol['FileSystemId'], vol['OntapConfiguration']['UUID'], metric)
+                    queries.append(getMetricQuery(query_id, metric, [
+                        {'Name': 'FileSystemId', 'Value': vol['FileSystemId']},
+                        {'Name': 'VolumeId', 'Value': vol['VolumeId']}
+                    ]))
+            if not response.get('NextToken'):
+                break
+            paginator_args['NextToken'] = response['NextToken']
+
+        #fleet configuration rules match SVM names
+        svm_names = {}
+        paginator_args = {'Filters': [{'Name': 'file-system-id', 'Values': list(prescreen.keys())}]}
+        while True:
+            response = client_fsx.describe_storage_virtual_machines(**paginator_args)
+            for svm in response['StorageVirtualMachines']:
+                svm_names[svm['StorageVirtualMachineId']] = svm['Name']
+            if not response.get('NextToken'):
+                break
+            paginator_args['NextToken'] = response['NextToken']
+        for screen in prescreen.values():
+            for vol in screen['volumes'].values():
+                vol['svm'] = svm_names.get(vol['svm'], "")
+    except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+        logger.error("Metrics pre-screen disabled, failed to list volumes: %s", e)
+        return {}
+
+    #fetch the latest datapoints, at most 500 queries per GetMetricData call
+    values = {}
+    end_time = datetime.now(timezone.utc)
+    start_time = datetime.fromtimestamp(end_time.timestamp() - vars.metrics_prescreen_lookback_in_minutes * 60, timezone.utc)
+    try:
+        for i in range(0, len(queries), 500):
+            request_args = {'MetricDataQueries': queries[i:i+500], 'StartTime': start_time, 'EndTime': end_time, 'ScanBy': 'TimestampDescending'}
+            while True:
+                response = metrics_client.get_metric_data(**request_args)
+                for result in response['MetricDataResults']:
+                    if result['Values'] and result['Id'] not in values:
+                        values[result['Id']] = result['Values'][0]
+                if not response.get('NextToken'):
+                    break
+                request_args['NextToken'] = response['NextToken']
+    except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+        logger.error("Metrics pre-screen disabled, failed to get metric data: %s", e)
+        return {}
+
+    #objects without datapoints are treated as near the thresholds
+    latest = {}
+    for query_id, key in query_keys.items():
+        if query_id in values:
+            latest[key] = values[query_id]
+    for fsxId, screen in prescreen.items():
+        used = latest.get((fsxId, "", "StorageUsed"))
+        capacity = latest.get((fsxId, "", "StorageCapacity"))
+        if used is not None and capacity:
+            screen['fs_near'] = (used/capacity)*100*1.1 >= getWarningFloor(fsx_configs[fsxId]) - vars.metrics_prescreen_margin
+        for vol_uuid, vol in screen['volumes'].items():
+            used = latest.get((fsxId, vol_uuid, "StorageUsed"))
+            capacity = latest.get((fsxId, vol_uuid, "StorageCapacity"))
+            if used is not None and capacity:
+                vol['per'] = (used/capacity)*100
+                policy = fsx_configs[fsxId]['policy_matcher'](vol['svm'], vol['name'])
+                vol['near'] = vol['per'] >= getWarningFloor(policy) - vars.metrics_prescreen_margin
+    return prescreen
+
+def getWarningFloor(policy):
+    #utilization above which an object is reported or resized
+    if policy['warn_notification']:
+        return min(75, float(policy['resize_threshold']))
+    return float(policy['resize_threshold'])
 
-                # Extract the list of records
-                records = aggr_data.get('records', [])
+def getFleetWarningFloor(fsx):
+    #lowest warning floor of the file system and its rules, objects below it need no action
+    return min(getWarningFloor(dict(fsx, **rule)) for rule in [{}] + fsx['rules'])
 
-                # Initialize variables
-                aggr_total = None
-                aggr_uuid = None
+def getMetricQuery(query_id, metric, dimensions):
+    return {
+        'Id': query_id,
+        'MetricStat': {
+            'Metric': {'Namespace': 'AWS/FSx', 'MetricName': metric, 'Dimensions': dimensions},
+            'Period': 300,
+            'Stat': 'Average'
+        },
+        'ReturnData': True
+    }
+
+def getAggrTotal(headers, fsxMgmtIp):
+    aggr_total = None
+    try:
+        # URL for fetching aggregate details
+        url_aggregate = "https://{}/api/storage/aggregates".format(fsxMgmtIp)
+
+        # Fetch aggregate details
+        response_aggregate = ontap_session.getCached(url_aggregate, headers)
+
+        if response_aggregate.status_code == 200:
+            # Parse the JSON response
+            aggr_data = response_aggregate.json()
 
-                # Iterate through the records to find the one with name 'aggr1'
-                for record in records:
-                    if record.get('name') == 'aggr1':
-                        aggr_uuid = record.get('uuid')
-                        logger.info("UUID found for aggr1: %s", aggr_uuid)
-                        break
+            # Extract the list of records
+            records = aggr_data.get('records', [])
 
-                if aggr_uuid:
-                    # URL for fetching data using UUID
-                    url_uuid = "https://{}/api/storage/aggregates/{}".format(vars.fsxList[fsxs]['fsxMgmtIp'], aggr_uuid)
+            # Initialize variables
+            aggr_uuid = None
 
-                    # Fetch data using UUID
-                    response_uuid = requests.get(url_uuid, headers=headers, verify=False)
-                    logger.info("response_uuid: %s", response_uuid)
+            # Iterate through the records to find the one with name 'aggr1'
+            for record in records:
+                if record.get('name') == 'aggr1':
+                    aggr_uuid = record.get('uuid')
+                    logger.info("UUID found for aggr1: %s", aggr_uuid)
+                    break
 
-                    if response_uuid.status_code == 200:
-                        # Parse the JSON response
-                        uuid_data = response_uuid.json()
+            if aggr_uuid:
+                # URL for fetching data using UUID
+                url_uuid = "https://{}/api/storage/aggregates/{}".format(fsxMgmtIp, aggr_uuid)
 
-                        # Extract relevant fields
-                        block_storage = uuid_data.get('space', {}).get('block_storage', {})
-                        size_bytes = block_storage.get('size')
+                # Fetch data using UUID
+                response_uuid = ontap_session.getCached(url_uuid, headers)
+                logger.info("response_uuid: %s", response_uuid)
 
-                        if size_bytes is not None:
-                            logger.info("Block storage details found for aggr1")
+                if response_uuid.status_code == 200:
+                    # Parse the JSON response
+                    uuid_data = response_uuid.json()
 
-                            # Convert bytes to GB
-                            size_gb = size_bytes / (1024 ** 3)
+                    # Extract relevant fields
+                    block_storage = uuid_data.get('space', {}).get('block_storage', {})
+                    size_bytes = block_storage.get('size')
 
-                            # Check if the size is in GB or TB
-                            if size_gb < 1024:
-                                aggr_total = size_gb
-                            else:
-                                aggr_total = size_gb / 1024
+                    if size_bytes is not None:
+                        logger.info("Block storage details found for aggr1")
 
-                            logger.info("Aggregate total size: %s GB", aggr_total)
+                        # Convert bytes to GB
+                        size_gb = size_bytes / (1024 ** 3)
+
+                        # Check if the size is in GB or TB
+                        if size_gb < 1024:
+                            aggr_total = size_gb
                         else:
-                            logger.info("Block storage size not found in UUID output")
+                            aggr_total = size_gb / 1024
+
+                        logger.info("Aggregate total size: %s GB", aggr_total)
                     else:
-                        logger.error("Failed to fetch data using UUID: %s %s", response_uuid.status_code, response_uuid.text)
+                        logger.info("Block storage size not found in UUID output")
                 else:
-                    logger.info("UUID not found or aggregate name is not aggr1")
+                    logger.error("Failed to fetch data using UUID: %s %s", response_uuid.status_code, response_uuid.text)
             else:
-                logger.error("Failed to fetch aggregate details: %s %s", response_aggregate.status_code, response_aggregate.text)
+                logger.info("UUID not found or aggregate name is not aggr1")
+        else:
+            logger.error("Failed to fetch aggregate details: %s %s", response_aggregate.status_code, response_aggregate.text)
+    except Exception as e:
+        logger.error("Error occurred while fetching aggregate details: %s", e)
+    return aggr_total
+
+def getLunDetails(headers, fsxMgmtIp, context=None, vol_uuid="", query=None, policy_matcher=None):
+    logger.info("Fetching LUN Details")
+    lun_details = []
+    params = dict(query or {})
+    if vol_uuid:
+        params['location.volume.uuid'] = vol_uuid
+
+    #the listing carries every field needed, LUNs are not fetched one by one
+    for values in iterOntapRecords(headers, fsxMgmtIp, "/api/storage/luns", LUN_FIELDS, params):
+        lun = getLunFromRecord(values)
+        if policy_matcher and policy_matcher(lun['svm'], lun['vol_name'])['exclude']:
+            continue
+        if deadlineReached(context):
+            logger.info("Deadline approaching. LUN inventory is incomplete")
+            return lun_details, False
+        lun_details.append(lun)
+    return lun_details, True
+
+def getLunDetail(headers, fsxMgmtIp, lun_uuid):
+    url_lun = "https://{}/api/storage/luns/{}".format(fsxMgmtIp, lun_uuid)
+    response_lun = ontap_session.getCached(url_lun, headers, {"fields": ",".join(LUN_FIELDS)})
+    record = response_lun.json()
+    return getLunFromRecord(tuple(getRecordField(record, field.split(".")) for field in LUN_FIELDS))
+
+def buildWorkItems(fsx_states, deferrals):
+    #risk is the distance of current utilization to the resize threshold, higher is riskier
+    work_items = []
+    for state in fsx_states:
+        fsx = state['fsx']
+        #classify all LUNs and volumes at once, only objects above the warning or resize thresholds become work items
+        luns, lun_policies = getIncludedObjects(state, state['lun_details'], "vol_name")
+        lun_table = fleet_table.newTable(luns, lun_policies)
+        lun_per, lun_risk, lun_status = fleet_table.classify(lun_table)
+        lun_targets = fleet_table.getTargetSizes(lun_table, lun_status)
+        autosize_managed = getAutosizeManaged(state)
+        vols, vol_policies = getIncludedObjects(state, state['vol_details'], "name")
+        vol_table = fleet_table.newTable(vols, vol_policies)
+        vol_per, vol_risk, vol_status = fleet_table.classify(vol_table)
+        vol_targets = fleet_table.getTargetSizes(vol_table, vol_status)
+        logger.info("%d of %d LUNs and %d of %d volumes of %s are above the warning or resize thresholds", sum(1 for status in lun_status if status != fleet_table.STATUS_OK), len(luns),
+                    sum(1 for status in vol_status if status != fleet_table.STATUS_OK), len(vols), fsx['fsxId'])
+
+        for i, lun in enumerate(luns):
+            if lun_status[i] == fleet_table.STATUS_OK:
+                continue
+            lun['target_size'] = float(lun_targets[i])
+            work_items.append({"type": "lun", "state": state, "object": lun, "risk": float(lun_risk[i]),
+                               "key": workItemKey(fsx['fsxId'], "lun", lun['uuid'])})
+        for i, vol in enumerate(vols):
+            if vol_status[i] == fleet_table.STATUS_RESIZE and vol['uuid'] in autosize_managed:
+                #ONTAP autosize grows the volume, it is only reported when autosize could not grow it
+                vol['autosize_maximum'] = autosize_managed[vol['uuid']]
+                work_items.append({"type": "autosize_limit", "state": state, "object": vol, "risk": float(vol_risk[i]),
+                                   "key": workItemKey(fsx['fsxId'], "vol", vol['uuid'])})
+            elif vol_status[i] != fleet_table.STATUS_OK:
+                vol['target_size'] = float(vol_targets[i])
+                work_items.append({"type": "vol", "state": state, "object": vol, "risk": float(vol_risk[i]),
+                                   "key": workItemKey(fsx['fsxId'], "vol", vol['uuid'])})
+            #snapshot cleanup never takes precedence over capacity work
+            if(vol_policies[i]['enable_snapshot_deletion']):
+                work_items.append({"type": "snapshot", "state": state, "object": vol, "risk": float(vol_risk[i]) - 200,
+                                   "key": workItemKey(fsx['fsxId'], "snapshot", vol['uuid'])})
+        #volumes screened out by metrics only need snapshot cleanup
+        for vol in state['snapshot_vols']:
+            policy = getObjectPolicy(state, vol['svm'], vol['name'])
+            if policy['exclude'] or not policy['enable_snapshot_deletion']:
+                continue
+            work_items.append({"type": "snapshot", "state": state, "object": vol, "risk": (vol['per'] or 0) - float(policy['resize_threshold']) - 200,
+                               "key": workItemKey(fsx['fsxId'], "snapshot", vol['uuid'])})
+        #settings that drifted from the policy are corrected before anything else
+        if state['autosize_drift']:
+            work_items.append({"type": "autosize", "state": state, "object": None, "risk": 100,
+                               "key": workItemKey(fsx['fsxId'], "autosize", "")})
+        #storage capacity math needs the complete volume inventory
+        if state['complete'] and not state['targeted'] and state['aggr_total']:
+            sc_used_per = (getStateScSpaceUsed(state)/float(state['aggr_total']))*100
+            work_items.append({"type": "sc", "state": state, "object": None, "risk": sc_used_per * 1.1 - float(fsx['resize_threshold']),
+                               "key": workItemKey(fsx['fsxId'], "sc", "")})
+    #capacity work goes first in risk order, work left over by the previous invocation goes first among equals.
+    #snapshot cleanup deferred for the most runs goes first, otherwise the same low risk volumes would wait forever
+    def getSortKey(item):
+        if item['type'] == "snapshot":
+            return (1, -deferrals.get(item['key'], 0), -item['risk'])
+        return (0, -item['risk'], item['key'] not in deferrals)
+    work_items.sort(key=getSortKey)
+    return work_items
+
+def getAutosizeManaged(state):
+    #returns {uuid: autosize maximum} of the thin volumes whose autosize matches the policy, the others drifted
+    autosize_managed = {}
+    if state['autosize_vols'] is None:
+        return autosize_managed
+    for vol in state['autosize_vols']:
+        policy = getObjectPolicy(state, vol['svm'], vol['name'])
+        if policy['exclude']:
+            continue
+        autosize_target = getAutosizeTarget(vol, policy)
+        if all(vol['autosize'][key] == value for key, value in autosize_target.items()):
+            autosize_managed[vol['uuid']] = autosize_target['maximum']
+        else:
+            state['autosize_drift'].append((vol, autosize_target))
+    logger.info("Autosize of %d thin volumes of %s matches the policy, %d drifted", len(autosize_managed), state['fsx']['fsxId'], len(state['autosize_drift']))
+    return autosize_managed
+
+def getIncludedObjects(state, objects, vol_name_key):
+    #objects not excluded by the fleet configuration and their policies
+    included = []
+    policies = []
+    for obj in objects:
+        policy = getObjectPolicy(state, obj['svm'], obj[vol_name_key])
+        if not policy['exclude']:
+            included.append(obj)
+            policies.append(policy)
+    return included, policies
+
+def runWorkItem(item, email_requirements):
+    #returns False when the deadline was reached before the item was finished
+    try:
+        if item['type'] == "lun":
+            processLun(item['state'], item['object'], email_requirements)
+        elif item['type'] == "vol":
+            processVolume(item['state'], item['object'], email_requirements)
+        elif item['type'] == "sc":
+            processStorageCapacity(item['state'], email_requirements)
+        elif item['type'] == "snapshot":
+            return processSnapshots(item['state'], item['object'], email_requirements)
+        elif item['type'] == "autosize":
+            reconcileAutosize(item['state'], email_requirements)
+        elif item['type'] == "autosize_limit":
+            notifyAutosizeLimit(item['state'], item['object'], email_requirements)
+    except Exception as e:
+        logger.error("Error occurred while processing %s: %s", item['key'], e)
+    return True
+
+def getScSpaceUsed(vol_details):
+    #returns the space consumed from storage capacity in GB
+    sc_space_used = fleet_table.getConsumedSpace(fleet_table.newTable(vol_details))
+    return sc_space_used/(1024*1024*1024)
+
+def getFsxVolumeId(client_fsx, vol_uuid):
+    vol_id = None
+    all_vol_details = client_fsx.describe_volumes()
+    for vol in all_vol_details['Volumes']:
+        if(vol['OntapConfiguration']['UUID'] == vol_uuid):
+            vol_id = vol['VolumeId']
+    return vol_id
+
+def updateVolumeSize(state, vol_uuid, new_vol_size_mb):
+    fsx = state['fsx']
+    job_status = 0
+    try:
+        vol_id = getFsxVolumeId(state['client_fsx'], vol_uuid)
+        update = state['client_fsx'].update_volume(VolumeId = vol_id, OntapConfiguration = {'SizeInMegabytes': new_vol_size_mb})
+    except botocore.exceptions.ClientError as e:
+        logger.error(e.response['Error']['Message'])
+        return job_status
+    #the resize goes through the FSx API, cached ONTAP responses of the volume are stale
+    ontap_session.invalidate("https://{}/api/storage/volumes/{}".format(fsx['fsxMgmtIp'], vol_uuid))
+    try:
+        url_job_monitor = "https://{}/api/cluster/jobs/{}".format(fsx['fsxMgmtIp'], update['ResponseMetadata']['RequestId'])
+        while(job_status not in ["success", "failure"] and int(update['ResponseMetadata']['HTTPStatusCode']) not in range(200,300)):
+            response_job_monitor = ontap_session.get(url_job_monitor, headers=state['headers'], verify=False)
+            job_status = response_job_monitor.json()['state']
+            if job_status == "failure":
+                logger.info("Failure in updating volume: {}".format(response_job_monitor.json()["error"]["message"]))
+            if response_job_monitor.status_code not in range(200, 300):
+                raise Exception(f"Failed to update Volume size. Status code: {response_job_monitor.status_code}, Response: {response_job_monitor.text}")
+            time.sleep(5)
+    except Exception as e:
+        logger.error("An error occurred while updating the Volume size: %s", e)
+    return job_status
+
+def updateLunSize(state, lun, new_lun_size, lun_per, email_requirements):
+    fsx = state['fsx']
+    policy = getObjectPolicy(state, lun['svm'], lun['vol_name'])
+    try:
+        data = { "space": { "size": new_lun_size}}
+        url_lun_update = "https://{}/api/storage/luns/{}".format(fsx['fsxMgmtIp'], lun['uuid'])
+        response_lun_update = ontap_session.patch(url_lun_update, headers=state['headers'], json=data, verify=False)
+        if response_lun_update.status_code not in range(200, 300):
+            raise Exception(f"Failed to update LUN size. Status code: {response_lun_update.status_code}, Response: {response_lun_update.text}")
+    except Exception as e:
+        logger.error("An error occurred while updating the LUN size: %s", e)
+    log = "LUN space used for LUN {} is greater than {}%. LUN resized to: {} GB".format(lun['name'], policy['resize_threshold'], round(new_lun_size/(1024*1024*1024),2))
+    logger.info(log)
+    email_requirements.append(
+        {
+            "case": "lun",
+            "name": lun['name'],
+            "use_per": round(lun_per,2),
+            "new_size": new_lun_size,
+            "warn": False
+        }
+    )
+
+def updateStorageCapacity(state, name, sc_space_used, email_requirements):
+    #grow storage capacity so that it can accomodate the space needed by volume name
+    fsx = state['fsx']
+    size = float(state['storage_capacity']) * 1.1
+    while float(size) < float(sc_space_used):
+        size = size * 1.1
+    size = math.ceil(size)
+    try:
+        state['client_fsx'].update_file_system(FileSystemId = fsx['fsxId'], StorageCapacity = size)
+    except botocore.exceptions.ClientError as e:
+        logger.error(e.response['Error']['Message'])
+    log = "Volume {} needs to be resized. However Storage capacity is out of space. Hence, File System Storage Capacity resized to: {} GB".format(name, size)
+    logger.info(log)
+    email_requirements.append(
+        {
+            "case": "sc",
+            "name": name,
+            "use_per": fsx['resize_threshold'],
+            "new_size": size,
+            "warn": True
+        }
+    )
+
+def getNewSize(size, used, policy):
+    #grow by the policy growth step until utilization is below the resize threshold
+    growth = 1 + float(policy['growth_percent'])/100
+    new_size = float(size) * growth
+    new_per = (float(used)/float(new_size))*100
+    while float(new_per) > float(policy['resize_threshold']):
+        new_size = new_size * growth
+        new_per = (float(used)/float(new_size))*100
+    return new_size
+
+def applyMaxSize(new_size, size, policy):
+    #returns the new size capped at the policy maximum or None when the maximum is already reached
+    if not policy['max_size_in_gb']:
+        return new_size
+    max_size = float(policy['max_size_in_gb'])*1024*1024*1024
+    if float(size) >= max_size:
+        return None
+    return min(new_size, max_size)
+
+def notifyMaxSize(case, name, use_per, policy, email_requirements):
+    log = "{} needs to be resized. However it has reached the maximum size of {} GB allowed by the policy".format(name, policy['max_size_in_gb'])
+    logger.info(log)
+    email_requirements.append(
+        {
+            "case": case,
+            "name": name,
+            "use_per": round(use_per,2),
+            "new_size": 0,
+            "warn": True
+        }
+    )
+
+def notifyAutosizeLimit(state, vol, email_requirements):
+    #a volume above the resize threshold with matching autosize is at the autosize maximum or the aggregate is full
+    policy = getObjectPolicy(state, vol['svm'], vol['name'])
+    vol_per = (float(vol['space_used'])/float(vol['space_total']))*100
+    if float(vol['space_total']) >= vol['autosize_maximum']:
+        logger.info("Volume %s has reached its autosize maximum of %s GB", vol['name'], round(vol['autosize_maximum']/(1024*1024*1024),2))
+        notifyMaxSize("vol_max_size", vol['name'], vol_per, policy, email_requirements)
+        return
+    logger.info("Volume %s is above %s%% but ONTAP autosize has not grown it up to %s GB. The aggregate may be full", vol['name'], policy['resize_threshold'], round(vol['autosize_maximum']/(1024*1024*1024),2))
+    email_requirements.append(
+        {
+            "case": "vol_notification",
+            "name": vol['name'],
+            "use_per": round(vol_per,2),
+            "new_size": 0,
+            "warn": True
+        }
+    )
+
+def processLun(state, lun, email_requirements):
+    fsx = state['fsx']
+    headers = state['headers']
+    policy = getObjectPolicy(state, lun['svm'], lun['vol_name'])
+
+    #check if LUN needs resizing and resize if allowed
+    lun_per = (float(lun['space_used'])/float(lun['space_total']))*100
+    if(policy['warn_notification'] and float(lun_per) > 75 and float(lun_per) < float(policy['resize_threshold'])):
+        email_requirements.append(
+            {
+                "case": "lun_notification",
+                "name": lun['name'],
+                "use_per": round(lun_per,2),
+                "new_size": 0,
+                "warn": False
+            }
+        )
+
+    if(float(lun_per) <= float(policy['resize_threshold'])):
+        log = "LUN space used by LUN {} is less than {}%. LUN Size Used = {}%".format(lun['name'], policy['resize_threshold'], round(lun_per,2))
+        logger.info(log)
+        return
+
+    new_lun_size = applyMaxSize(lun.get('target_size') or getNewSize(lun['space_total'], lun['space_used'], policy), lun['space_total'], policy)
+    if new_lun_size is None:
+        notifyMaxSize("lun_max_size", lun['name'], lun_per, policy, email_requirements)
+        return
+    new_lun_size = math.ceil(new_lun_size)
+
+    #LUN is thin provisioned
+    if(lun['space_reserved'] != True):
+        logger.info("LUN is thin provisioned")
+        updateLunSize(state, lun, new_lun_size, lun_per, email_requirements)
+        return
+
+    logger.info("LUN is thick provisioned")
+    #check if vol size can accomodate new lun size
+    if state['filtered']:
+        #a filtered inventory misses the LUNs below the floor, list all LUNs of the volume
+        vol_luns, _ = getLunDetails(headers, fsx['fsxMgmtIp'], vol_uuid=lun['vol_uuid'])
+        lun_space_used = fleet_table.getConsumedSpace(fleet_table.newTable(vol_luns))
+    else:
+        if 'lun_space_by_vol' not in state:
+            state['lun_space_by_vol'] = fleet_table.getConsumedSpaceByGroup(fleet_table.newTable(state['lun_details'], group_key="vol_uuid"))
+        lun_space_used = state['lun_space_by_vol'][lun['vol_uuid']]
+    lun_space_used = lun_space_used - float(lun['space_total']) + new_lun_size
+
+    lun_vol = getVolDetail(headers, fsx['fsxMgmtIp'], lun['vol_uuid'])
+    vol_per = (float(lun_vol['space_used'])/float(lun_vol['space_total']))*100
+
+    #update LUN size if vol size can accomodate
+    growth = 1 + float(policy['growth_percent'])/100
+    if(float(lun_space_used * growth) < float(lun_vol['space_total'])):
+        updateLunSize(state, lun, new_lun_size, lun_per, email_requirements)
+        return
+
+    #update the volume size followed by lun size
+    new_vol_size = float(lun_vol['space_total']) * growth
+    while(float(lun_space_used) > new_vol_size):
+        new_vol_size *= growth
+    new_vol_size = applyMaxSize(new_vol_size, lun_vol['space_total'], policy)
+    if new_vol_size is None or new_vol_size < lun_space_used:
+        notifyMaxSize("vol_max_size", lun['vol_name'], vol_per, policy, email_requirements)
+        return
+    new_vol_size_mb = new_vol_size/(1024*1024)
+    new_vol_size_mb = math.ceil(new_vol_size_mb)
+
+    #Volume is thick provisioned
+    if(lun_vol['guarantee'] == "volume"):
+        logger.info("LUN: Volume is thick provisioned")
+        #check if sc can accomodate new vol size
+        state['sc_vols'] = getVolumeSpaceSummaries(headers, fsx['fsxMgmtIp'])
+        sc_space_used = getScSpaceUsed(state['sc_vols']) + (new_vol_size - lun_vol['space_total'])/(1024*1024*1024)
+
+        #else update sc followed by vol followed by lun
+        if(float(sc_space_used * 1.1) >= float(state['aggr_total'])):
+            updateStorageCapacity(state, lun['vol_name'], sc_space_used, email_requirements)
+            return
+    else:
+        logger.info("LUN: Volume is thin provisioned")
+
+    #update vol
+    job_status = updateVolumeSize(state, lun['vol_uuid'], new_vol_size_mb)
+    if job_status == "success":
+        log = "LUN space used for LUN {} is greater than {}%. However volume size for volume {} cannot support increase in LUN size. Hence increasing volume size to {} GB".format(lun['name'], policy['resize_threshold'], lun['vol_name'], round((new_vol_size_mb/1024),2))
+        logger.info(log)
+        email_requirements.append(
+            {
+                "case": "vol",
+                "name": lun_vol['name'],
+                "use_per": round(vol_per,2),
+                "new_size": new_vol_size_mb,
+                "warn": False
+            }
+        )
+
+    #update lun
+    updateLunSize(state, lun, new_lun_size, lun_per, email_requirements)
+
+def processVolume(state, vol, email_requirements):
+    fsx = state['fsx']
+    headers = state['headers']
+    policy = getObjectPolicy(state, vol['svm'], vol['name'])
+
+    #check if volume needs resizing and resize if allowed and send email
+    logger.info("Checking if volume needs resizing and resize if allowed and send email")
+    vol_per = (float(vol['space_used'])/float(vol['space_total']))*100
+    if(policy['warn_notification'] and float(vol_per) > 75 and float(vol_per) < float(policy['resize_threshold'])):
+        email_requirements.append(
+            {
+                "case": "vol_notification",
+                "name": vol['name'],
+                "use_per": round(vol_per,2),
+                "new_size": 0,
+                "warn": False
+            }
+        )
+
+    if(float(vol_per) <= float(policy['resize_threshold'])):
+        log = "Volume space used by volume {} is less than {}%. Volume Size Used = {}%".format(vol['name'], policy['resize_threshold'], round(vol_per,2))
+        logger.info(log)
+        return
+
+    logger.info("Volume space used for volume {} is {} and it is greater than {}%.".format(vol['name'], float(vol_per), policy['resize_threshold']))
+
+    #free space by deleting expired snapshots before growing the volume or the storage capacity
+    if vars.enable_snapshot_reclaim and policy['enable_snapshot_deletion'] and reclaimSnapshotSpace(state, vol, vol_per, policy, email_requirements):
+        return
+
+    new_vol_size = applyMaxSize(vol.get('target_size') or getNewSize(vol['space_total'], vol['space_used'], policy), vol['space_total'], policy)
+    if new_vol_size is None:
+        notifyMaxSize("vol_max_size", vol['name'], vol_per, policy, email_requirements)
+        return
+    new_vol_size_mb = new_vol_size/(1024*1024)
+    new_vol_size_mb = math.ceil(new_vol_size_mb)
+
+    #thick provisioned volume
+    if(vol['guarantee'] == "volume"):
+        logger.info("Preparing to update volume: thick provisioned volume")
+
+        #check if sc can accomodate new vol size
+        state['sc_vols'] = getVolumeSpaceSummaries(headers, fsx['fsxMgmtIp'])
+        sc_space_used = getScSpaceUsed(state['sc_vols']) + (new_vol_size - vol['space_total'])/(1024*1024*1024)
+
+        #update sc followed by vol
+        if(float(sc_space_used * 1.1) >= float(state['aggr_total'])):
+            updateStorageCapacity(state, vol['name'], sc_space_used, email_requirements)
+            return
+    #thin provisioned volume
+    else:
+        logger.info("Preparing to update volume: thin provisioned volume")
+
+    #update vol
+    job_status = updateVolumeSize(state, vol['uuid'], new_vol_size_mb)
+    if job_status == "success":
+        log = "Volume space used for volume {} is greater than {}%. Volume resized to: {} GB".format(vol['name'], policy['resize_threshold'], round(new_vol_size_mb/1024,2))
+        logger.info(log)
+        email_requirements.append(
+            {
+                "case": "vol",
+                "name": vol['name'],
+                "use_per": round(vol_per,2),
+                "new_size": new_vol_size_mb,
+                "warn": False
+            }
+        )
+
+def reclaimSnapshotSpace(state, vol, vol_per, policy, email_requirements):
+    #deletes the fewest expired snapshots whose reclaimable space brings the volume under the resize threshold
+    fsx = state['fsx']
+    needed = float(vol['space_used']) - float(vol['space_total']) * float(policy['resize_threshold']) / 100
+    cutoff = datetime.now(timezone.utc).replace(microsecond=0) - timedelta(days=policy['snapshot_age_threshold_in_days'] + 1)
+    clone_parents = set(volume['parent_snapshot'] for volume in getCloneVolumes(state))
+    candidates = []
+    path = "/api/storage/volumes/{}/snapshots".format(vol['uuid'])
+    fields = ["uuid", "name", "create_time", "size", "reclaimable_space"]
+    for uuid, name, create_time, size, reclaimable_space in iterOntapRecords(state['headers'], fsx['fsxMgmtIp'], path, fields, {"create_time": "<=" + cutoff.isoformat()}):
+        if name in clone_parents or uuid in state['reclaimed_snapshots'] or not reclaimable_space:
+            continue
+        if datetime.fromisoformat(create_time.replace('Z', '+00:00')) > cutoff:
+            continue
+        candidates.append({"uuid": uuid, "name": name, "size": size, "reclaimable_space": reclaimable_space})
+
+    #largest first needs the fewest snapshots, the estimates of single snapshots are a lower bound for deleting them together
+    candidates.sort(key=lambda snapshot: snapshot['reclaimable_space'], reverse=True)
+    plan = []
+    planned = 0
+    for snapshot in candidates:
+        if planned >= needed:
+            break
+        plan.append(snapshot)
+        planned += snapshot['reclaimable_space']
+    if planned < needed:
+        logger.info("Expired snapshots of volume %s can reclaim %d of the %d bytes needed to get under %s%%. Resizing instead", vol['name'], planned, needed, policy['resize_threshold'])
+        return False
+
+    url = "https://{}/api/storage/volumes/{}/snapshots".format(fsx['fsxMgmtIp'], vol['uuid'])
+    for i in range(0, len(plan), vars.bulk_snapshot_deletion_batch_size):
+        batch = plan[i:i+vars.bulk_snapshot_deletion_batch_size]
+        try:
+            params = {"uuid": "|".join(snapshot['uuid'] for snapshot in batch), "return_timeout": 0}
+            response_ss_delete = ontap_session.delete(url, headers=state['headers'], params=params, verify=False)
+            if response_ss_delete.status_code not in range(200, 300):
+                raise Exception("Status code: %d, Response: %s" % (response_ss_delete.status_code, response_ss_delete.text))
+            job_status = waitForJob(state, response_ss_delete.json()['job']['uuid'])
         except Exception as e:
-            logger.error("Error occurred while fetching aggregate details: %s", e)
-        #get lun details
-        url_lun = "https://{}/api/storage/luns".format(vars.fsxList[fsxs]['fsxMgmtIp'])
-        response_lun = requests.get(url_lun, headers=headers, verify=False)
-
-        for i in range(len(response_lun.json()['records'])):
-            lun_id = response_lun.json()['records'][i]['uuid']
-            url_lun = "https://{}/api/storage/luns/{}".format(vars.fsxList[fsxs]['fsxMgmtIp'],lun_id)
-            response_lun_loop = requests.get(url_lun, headers=headers, verify=False)
-            lun_details.append(
-                {
-                    "name": response_lun_loop.json()['location']['logical_unit'], 
-                    "vol_name": response_lun_loop.json()['location']['volume']['name'],
-                    "vol_uuid": response_lun_loop.json()['location']['volume']['uuid'],
-                    "space_total": response_lun_loop.json()['space']['size'],
-                    "space_used": response_lun_loop.json()['space']['used'],
-                    "space_reserved": response_lun_loop.json()['space']['guarantee']['reserved']
-                }
-            )
-            
-            #check if LUN needs resizing and resize if allowed
-            lun_per = (float(response_lun_loop.json()['space']['used'])/float(response_lun_loop.json()['space']['size']))*100 
-            if(vars.fsxList[fsxs]['warn_notification'] and float(lun_per) > 75 and float(lun_per) < float(vars.fsxList[fsxs]['resize_threshold'])):
-                email_requirements.append(
-                    {
-                        "case": "lun_notification",
-                        "name": response_lun_loop.json()['location']['logical_unit'],
-                        "use_per": round(lun_per,2),
-                        "new_size": 0,
-                        "warn": False
-                    }
-                )
+            logger.error("An error occurred while reclaiming snapshot space of volume %s: %s", vol['name'], e)
+            job_status = "failure"
+        if job_status != "success":
+            logger.info("Snapshot space of volume %s could not be reclaimed. Resizing instead", vol['name'])
+            return False
+        state['reclaimed_snapshots'].update(snapshot['uuid'] for snapshot in batch)
 
+    log = "Volume space used for volume {} is greater than {}%. Deleted {} expired snapshots reclaiming at least {} GB instead of resizing the volume".format(vol['name'], policy['resize_threshold'], len(plan), round(planned/(1024*1024*1024),2))
+    logger.info(log)
+    email_requirements.append(
+        {
+            "case": "vol_reclaim",
+            "name": vol['name'],
+            "use_per": round(vol_per,2),
+            "new_size": planned,
+            "warn": False
+        }
+    )
+    return True
 
-            if(float(lun_per) > float(vars.fsxList[fsxs]['resize_threshold'])):
-                new_lun_size = float(response_lun_loop.json()['space']['size']) * 1.05
-                new_lun_per = (float(response_lun_loop.json()['space']['used'])/float(new_lun_size))*100 
-                while float(new_lun_per) > float(vars.fsxList[fsxs]['resize_threshold']):
-                    new_lun_size = new_lun_size * 1.05
-                    new_lun_per = (float(response_lun_loop.json()['space']['used'])/float(new_lun_size))*100 
-                new_lun_size = math.ceil(new_lun_size)
-                
-                #check if LUN is thick provisioned
-                if(response_lun_loop.json()['space']['guarantee']['reserved'] == True):
-                    logger.info("LUN is thick provisioned")
-                    #check if vol size can accomodate new lun size
-                    lun_space_used = 0
-                    for lun in lun_details:
-                        if(lun['vol_name'] == response_lun_loop.json()['location']['volume']['name']):
-                            if(lun['space_reserved'] == True):
-                                lun_space_used += lun['space_total']
-                            else:
-                                lun_space_used += lun['space_used']
-
-                    if(response_lun_loop.json()['space']['guarantee']['reserved'] == True):
-                        lun_space_used = lun_space_used - float(response_lun_loop.json()['space']['size']) + new_lun_size
-                    else:          
-                        lun_space_used = lun_space_used - float(response_lun_loop.json()['space']['used']) + new_lun_size
-                    
-                    url = "https://{}/api/storage/volumes/{}?fields=*,guarantee".format(vars.fsxList[fsxs]['fsxMgmtIp'],response_lun_loop.json()['location']['volume']['uuid'])
-                    response_vol = requests.get(url, headers=headers, verify=False)
-                    vol_per = (float(response_vol.json()['space']['size'] - response_vol.json()['space']['available'])/float(response_vol.json()['space']['size']))*100 
-
-                    #update LUN size if vol size can accomodate
-                    if(float(lun_space_used * 1.05) < float(response_vol.json()['space']['size'])):
-                        try:
-                            data = { "space": { "size": new_lun_size}}
-                            url_lun_update = "https://{}/api/storage/luns/{}".format(vars.fsxList[fsxs]['fsxMgmtIp'], lun_id)
-                            response_lun_update = requests.patch(url_lun_update, headers=headers, json=data, verify=False)
-                            if response_lun_update.status_code not in range(200, 300):
-                                raise Exception(f"Failed to update LUN size. Status code: {response_lun_update.status_code}, Response: {response_lun_update.text}")
-                        except Exception as e:
-                            logger.error("An error occurred while updating the LUN size: %s", e)
-
-                        log = "LUN space used for LUN {} is greater than {}%. LUN resized to: {} GB".format(response_lun_loop.json()['location']['logical_unit'],vars.fsxList[fsxs]['resize_threshold'],round(new_lun_size/(1024*1024*1024),2))
-                        logger.info(log)
-                        email_requirements.append(
-                            {
-                                "case": "lun",
-                                "name": response_lun_loop.json()['location']['logical_unit'],
-                                "use_per": round(lun_per,2),
-                                "new_size": new_lun_size,
-                                "warn": False
-                            }
-                        )
-                    #update the volume size followed by lun size
-                    else:
-                        new_vol_size = float(response_vol.json()['space']['size']) * 1.05
-                        while(float(lun_space_used) > new_vol_size):
-                            new_vol_size *= 1.05
-                        new_vol_size_mb = new_vol_size/(1024*1024)
-                        new_vol_size_mb = math.ceil(new_vol_size_mb)
-
-                        #Volume is thick provisioned
-                        if(response_vol.json()['guarantee']['type'] == "volume"):
-                            logger.info("LUN: Volume is thick provisioned")
-                            #check if sc can accomodate new vol size
-                            sc_space_used = 0
-                            vol_details = getVolDetails(headers, [], vars.fsxList[fsxs]['fsxMgmtIp'])
-                            for vol in vol_details:
-                                if(vol['guarantee'] == "volume"):
-                                    sc_space_used += vol['space_total']
-                                else:
-                                    sc_space_used += vol['space_used']
-                            
-                            if(response_vol.json()['guarantee']['type'] == "volume"):
-                                sc_space_used = sc_space_used - response_vol.json()['space']['size'] + new_vol_size
-                            else:
-                                sc_space_used = sc_space_used - response_vol.json()['space']['used'] + new_vol_size
-                            
-                            sc_space_used = sc_space_used/(1024*1024*1024)
-
-                            #update vol size if sc can accomodate
-                            if(float(sc_space_used * 1.1) < float(aggr_total)):
-                                #update vol
-                                all_vol_details = client_fsx.describe_volumes()
-                                for vol in all_vol_details['Volumes']:
-                                    if(vol['OntapConfiguration']['UUID'] == response_lun_loop.json()['location']['volume']['uuid']):
-                                        vol_id = vol['VolumeId']
-                                try:
-                                    update = client_fsx.update_volume(VolumeId = vol_id, OntapConfiguration = {'SizeInMegabytes': new_vol_size_mb})
-                                except botocore.exceptions.ClientError as e:
-                                    logger.error(e.response['Error']['Message'])
-                                try:
-                                    url_job_monitor = "https://{}/api/cluster/jobs/{}".format(vars.fsxList[fsxs]['fsxMgmtIp'], update['ResponseMetadata']['RequestId'])
-                                    job_status = 0
-                                    while(job_status not in ["success", "failure"] and int(update['ResponseMetadata']['HTTPStatusCode']) not in range(200,300)):
-                                        response_job_monitor = requests.get(url_job_monitor, headers=headers, verify=False)
-                                        job_status = response_job_monitor.json()['state']
-                                        if job_status == "failure":
-                                            logger.info("Failure in updating volume: {}".format(response_job_monitor.json()["error"]["message"]))
-                                        if response_job_monitor.status_code not in range(200, 300):
-                                            raise Exception(f"Failed to update Volume size. Status code: {response_job_monitor.status_code}, Response: {response_job_monitor.text}")
-                                        time.sleep(5)
-                                except Exception as e:
-                                    logger.error("An error occurred while updating the Volume size:", e)
-                                
-                                if job_status == "success":
-                                    log = "LUN space used for LUN {} is greater than {}%. However volume size for volume {} cannot support increase in LUN size. Hence increasing volume size to {} GB".format(response_lun_loop.json()['location']['logical_unit'],vars.fsxList[fsxs]['resize_threshold'], response_lun_loop.json()['location']['volume']['name'], round((new_vol_size_mb/1024),2))                
-                                    logger.info(log)
-                                    email_requirements.append(
-                                        {
-                                            "case": "vol",
-                                            "name": response_vol.json()['name'],
-                                            "use_per": round(vol_per,2),
-                                            "new_size": new_vol_size_mb,
-                                            "warn": False
-                                        }
-                                    )
-
-                                #update lun
-                                try:
-                                    data = { "space": { "size": new_lun_size}}
-                                    url_lun_update = "https://{}/api/storage/luns/{}".format(vars.fsxList[fsxs]['fsxMgmtIp'], lun_id)
-                                    response_lun_update = requests.patch(url_lun_update, headers=headers, json=data, verify=False)
-                                    if response_lun_update.status_code not in range(200, 300):
-                                        raise Exception(f"Failed to update LUN size. Status code: {response_lun_update.status_code}, Response: {response_lun_update.text}")
-                                except Exception as e:
-                                    logger.error("An error occurred while updating the LUN size: %s", e)
-                                log = "LUN space used for LUN {} is greater than {}%. LUN resized to: {} GB".format(response_lun_loop.json()['location']['logical_unit'],vars.fsxList[fsxs]['resize_threshold'],round(new_lun_size/(1024*1024*1024),2))
-                                logger.info(log)
-                                email_requirements.append(
-                                    {
-                                        "case": "lun",
-                                        "name": response_lun_loop.json()['location']['logical_unit'],
-                                        "use_per": round(lun_per,2),
-                                        "new_size": new_lun_size,
-                                        "warn": False
-                                    }
-                                )
-                            #else update sc followed by vol followed by lun
-                            else:
-                                #update sc
-                                size = float(storage_capacity) * 1.1
-                                while float(size) < float(sc_space_used):
-                                    size = size * 1.1
-                                size = math.ceil(size)
-                                try:
-                                    update = client_fsx.update_file_system(FileSystemId = vars.fsxList[fsxs]['fsxId'], StorageCapacity = size)
-                                except botocore.exceptions.ClientError as e:
-                                    logger.error(e.response['Error']['Message'])
-                                log = "Volume {} needs to be resized. However Storage capacity is out of space. Hence, File System Storage Capacity resized to: {} GB".format(response_lun_loop.json()['location']['volume']['name'], size)
-                                logger.info(log)
-                                email_requirements.append(
-                                    {
-                                        "case": "sc",
-                                        "name": response_lun_loop.json()['location']['volume']['name'],
-                                        "use_per": vars.fsxList[fsxs]['resize_threshold'],
-                                        "new_size": size,
-                                        "warn": True
-                                    }
-                                )
-
-                                # #update vol
-                                # all_vol_details = client_fsx.describe_volumes()
-                                # for vol in all_vol_details['Volumes']:
-                                #     if(vol['OntapConfiguration']['UUID'] == response_lun_loop.json()['location']['volume']['uuid']):
-                                #         vol_id = vol['VolumeId']
-                                # update = client_fsx.update_volume(VolumeId = vol_id, OntapConfiguration = {'SizeInMegabytes': new_vol_size_mb})
-                                # time.sleep(30)
-                                # log = "LUN space used for LUN {} is greater than {}%. However volume size for volume {} cannot support increase in LUN size. Hence increasing volume size to {} GB".format(response_lun_loop.json()['location']['logical_unit'],vars.resize_threshold, response_lun_loop.json()['location']['volume']['name'], round(new_vol_size_mb/1024,2))                
-                                # sendEmail("vol", response_vol.json()['name'], vars.resize_threshold, new_vol_size_mb)
-                                # logger.info(log)
-
-                                # #update lun
-                                # data = { "space": { "size": new_lun_size}}
-                                # url_lun_update = "https://{}/api/storage/luns/{}".format(vars.fsxMgmtIp, lun_id)
-                                # response_lun_update = requests.patch(url_lun_update, headers=headers, json=data, verify=False)
-                                # try:
-                                #     response_lun_update.raise_for_status()
-                                # except requests.exceptions.HTTPError as e:
-                                #     return {
-                                #         'statusCode': 400,
-                                #         'body': "Error: " + str(e) 
-                                #     }
-                                # log = "LUN space used for LUN {} is greater than {}%. LUN resized to: {} GB".format(response_lun_loop.json()['location']['logical_unit'],vars.resize_threshold,round(new_lun_size/(1024*1024*1024),2))
-                                # sendEmail("lun", response_lun_loop.json()['location']['logical_unit'], vars.resize_threshold, new_lun_size)
-                                # logger.info(log)
-                        #volume is thin provisioned
-                        else:
-                            logger.info("LUN: Volume is thin provisioned")
-                            #update vol
-                            all_vol_details = client_fsx.describe_volumes()
-                            for vol in all_vol_details['Volumes']:
-                                if(vol['OntapConfiguration']['UUID'] == response_lun_loop.json()['location']['volume']['uuid']):
-                                    vol_id = vol['VolumeId']
-                            try:
-                                update = client_fsx.update_volume(VolumeId = vol_id, OntapConfiguration = {'SizeInMegabytes': new_vol_size_mb})
-                            except botocore.exceptions.ClientError as e:
-                                    logger.error(e.response['Error']['Message'])
-                            try:
-                                url_job_monitor = "https://{}/api/cluster/jobs/{}".format(vars.fsxList[fsxs]['fsxMgmtIp'], update['ResponseMetadata']['RequestId'])
-                                job_status = 0
-                                while(job_status not in ["success", "failure"] and int(update['ResponseMetadata']['HTTPStatusCode']) not in range(200,300)):
-                                    response_job_monitor = requests.get(url_job_monitor, headers=headers, verify=False)
-                                    job_status = response_job_monitor.json()['state']
-                                    if job_status == "failure":
-                                        logger.info("Failure in updating volume: {}".format(response_job_monitor.json()["error"]["message"]))
-                                    if response_job_monitor.status_code not in range(200, 300):
-                                        raise Exception(f"Failed to update Volume size. Status code: {response_job_monitor.status_code}, Response: {response_job_monitor.text}")
-                                    time.sleep(5)
-                            except Exception as e:
-                                logger.error("An error occurred while updating the Volume size:", e)
-                            
-                            if job_status == "success":
-                                log = "LUN space used for LUN {} is greater than {}%. However volume size for volume {} cannot support increase in LUN size. Hence increasing volume size to {} GB".format(response_lun_loop.json()['location']['logical_unit'],vars.fsxList[fsxs]['resize_threshold'], response_lun_loop.json()['location']['volume']['name'], round(new_vol_size_mb/1024,2))                
-                                logger.info(log)
-                                email_requirements.append(
-                                    {
-                                        "case": "vol",
-                                        "name": response_vol.json()['name'],
-                                        "use_per": round(vol_per,2),
-                                        "new_size": new_vol_size_mb,
-                                        "warn": False
-                                    }
-                                )
-
-                            #update lun
-                            try:
-                                data = { "space": { "size": new_lun_size}}
-                                url_lun_update = "https://{}/api/storage/luns/{}".format(vars.fsxList[fsxs]['fsxMgmtIp'], lun_id)
-                                response_lun_update = requests.patch(url_lun_update, headers=headers, json=data, verify=False)
-                                if response_lun_update.status_code not in range(200, 300):
-                                    raise Exception(f"Failed to update LUN size. Status code: {response_lun_update.status_code}, Response: {response_lun_update.text}")
-                            except Exception as e:
-                                logger.error("An error occurred while updating the LUN size: %s", e)
-                            log = "LUN space used for LUN {} is greater than {}%. LUN resized to: {} GB".format(response_lun_loop.json()['location']['logical_unit'],vars.fsxList[fsxs]['resize_threshold'],round(new_lun_size/(1024*1024*1024),2))
-                            logger.info(log)
-                            email_requirements.append(
-                                {
-                                    "case": "lun",
-                                    "name": response_lun_loop.json()['location']['logical_unit'],
-                                    "use_per": round(lun_per,2),
-                                    "new_size": new_lun_size,
-                                    "warn": False
-                                }
-                            )
-
-                #LUN is thin provisioned
-                else:
-                    logger.info("LUN is thin provisioned")
-                    #update lun
-                    try:
-                        data = { "space": { "size": new_lun_size}}
-                        url_lun_update = "https://{}/api/storage/luns/{}".format(vars.fsxList[fsxs]['fsxMgmtIp'], lun_id)
-                        response_lun_update = requests.patch(url_lun_update, headers=headers, json=data, verify=False)
-                        if response_lun_update.status_code not in range(200, 300):
-                            raise Exception(f"Failed to update LUN size. Status code: {response_lun_update.status_code}, Response: {response_lun_update.text}")
-                    except Exception as e:
-                        logger.error("An error occurred while updating the LUN size: %s", e)
-                    log = "LUN space used for LUN {} is greater than {}%. LUN resized to: {} GB".format(response_lun_loop.json()['location']['logical_unit'],vars.fsxList[fsxs]['resize_threshold'],round(new_lun_size/(1024*1024*1024),2))
-                    logger.info(log)
-                    email_requirements.append(
-                        {
-                            "case": "lun",
-                            "name": response_lun_loop.json()['location']['logical_unit'],
-                            "use_per": round(lun_per,2),
-                            "new_size": new_lun_size,
-                            "warn": False
-                        }
-                    )
-                        
+def waitForJob(state, job_uuid):
+    job_status = 0
+    url_job_monitor = "https://{}/api/cluster/jobs/{}".format(state['fsx']['fsxMgmtIp'], job_uuid)
+    while(job_status not in ["success", "failure"]):
+        if deadlineReached(state['context']):
+            logger.info("Deadline approaching. Not waiting for job %s", job_uuid)
+            break
+        response_job_monitor = ontap_session.get(url_job_monitor, headers=state['headers'], verify=False)
+        if response_job_monitor.status_code not in range(200, 300):
+            raise Exception("Failed to monitor job %s. Status code: %d, Response: %s" % (job_uuid, response_job_monitor.status_code, response_job_monitor.text))
+        job_status = response_job_monitor.json()['state']
+        if job_status == "failure":
+            logger.info("Failure in job %s: %s", job_uuid, response_job_monitor.json()["error"]["message"])
+        elif job_status != "success":
+            time.sleep(5)
+    return job_status
 
-            else:
-                log = "LUN space used by LUN {} is less than {}%. LUN Size Used = {}%".format(response_lun_loop.json()['location']['logical_unit'], vars.fsxList[fsxs]['resize_threshold'], round(lun_per,2))
-                logger.info(log)
+def reconcileAutosize(state, email_requirements):
+    #volumes that drifted keep being resized by the function until their autosize is corrected
+    fsx = state['fsx']
+    for vol, autosize_target in state['autosize_drift']:
+        try:
+            url = "https://{}/api/storage/volumes/{}".format(fsx['fsxMgmtIp'], vol['uuid'])
+            response_autosize = ontap_session.patch(url, headers=state['headers'], json={"autosize": autosize_target}, params={"return_timeout": 30}, verify=False)
+            if response_autosize.status_code not in range(200, 300):
+                raise Exception("Status code: %d, Response: %s" % (response_autosize.status_code, response_autosize.text))
+            job_status = "success"
+            if response_autosize.status_code == 202:
+                job_status = waitForJob(state, response_autosize.json()['job']['uuid'])
+        except Exception as e:
+            logger.error("An error occurred while configuring autosize of volume %s: %s", vol['name'], e)
+            continue
+        if job_status != "success":
+            continue
+        log = "Autosize of volume {} changed from {} to grow at {}% up to {} GB".format(vol['name'], vol['autosize'], autosize_target['grow_threshold'], round(autosize_target['maximum']/(1024*1024*1024),2))
+        logger.info(log)
+        email_requirements.append(
+            {
+                "case": "vol_autosize",
+                "name": vol['name'],
+                "use_per": round((float(vol['space_used'])/float(vol['space_total']))*100,2),
+                "new_size": autosize_target['maximum'],
+                "warn": False
+            }
+        )
 
-    
-    
-        #get volume details
-        logger.info("Get volume details")
-        url = "https://{}/api/storage/volumes".format(vars.fsxList[fsxs]['fsxMgmtIp'])
-        response = requests.get(url, headers=headers, verify=False)
-        
-        for i in range(len(response.json()['records'])):
-            temp = response.json()['records'][i]['uuid']
-            url = "https://{}/api/storage/volumes/{}?fields=*,guarantee,clone.is_flexclone,clone.parent_snapshot.name".format(vars.fsxList[fsxs]['fsxMgmtIp'],temp)
-            response_vol = requests.get(url, headers=headers, verify=False)
-            if(response_vol.json()["clone"]["is_flexclone"]):
-                vol_details.append(
-                    {
-                        "name": response_vol.json()['name'], 
-                        "uuid": response.json()['records'][i]['uuid'],
-                        "space_total": response_vol.json()['space']['size'],
-                        "space_used": response_vol.json()['space']['size'] - response_vol.json()['space']['available'],
-                        "guarantee": response_vol.json()['guarantee']['type'],
-                        "is_flexclone": True,
-                        "parent_snapshot": response_vol.json()['clone']['parent_snapshot']['name']
-                    }
-                )
-            else:
-                vol_details.append(
-                    {
-                        "name": response_vol.json()['name'], 
-                        "uuid": response.json()['records'][i]['uuid'],
-                        "space_total": response_vol.json()['space']['size'],
-                        "space_used": response_vol.json()['space']['size'] - response_vol.json()['space']['available'],
-                        "guarantee": response_vol.json()['guarantee']['type'],
-                        "is_flexclone": False,
-                        "parent_snapshot": ""
-                    }
-                )
-            
-            #check if volume needs resizing and resize if allowed and send email
-            logger.info("Checking if volume needs resizing and resize if allowed and send email")
-            vol_per = (float(response_vol.json()['space']['size'] - response_vol.json()['space']['available'])/float(response_vol.json()['space']['size']))*100 
-            if(vars.fsxList[fsxs]['warn_notification'] and float(vol_per) > 75 and float(vol_per) < float(vars.fsxList[fsxs]['resize_threshold'])):
-                email_requirements.append(
-                    {
-                        "case": "vol_notification",
-                        "name": response_vol.json()['name'],
-                        "use_per": round(vol_per,2),
-                        "new_size": 0,
-                        "warn": False
-                    }
-                )
-            if(float(vol_per) > float(vars.fsxList[fsxs]['resize_threshold'])):
-                logger.info("Volume space used for volume {} is {} and it is greater than {}%.".format(response_vol.json()['name'], float(vol_per), vars.fsxList[fsxs]['resize_threshold']))
-                new_vol_size = float(response_vol.json()['space']['size']) * 1.05
-                new_vol_per = (float(response_vol.json()['space']['size'] - response_vol.json()['space']['available'])/float(new_vol_size))*100 
-                while float(new_vol_per) > float(vars.fsxList[fsxs]['resize_threshold']):
-                    new_vol_size = new_vol_size * 1.05
-                    new_vol_per = (float(response_vol.json()['space']['size'] - response_vol.json()['space']['available'])/float(new_vol_size))*100 
-                new_vol_size_mb = new_vol_size/(1024*1024)
-                new_vol_size_mb = math.ceil(new_vol_size_mb)
-
-                #thick provisioned volume
-                if(response_vol.json()['guarantee']['type'] == "volume"):
-                    logger.info("Preparing to update volume: thin provisioned volume")
-
-                    #check if sc can accomodate new vol size
-                    sc_space_used = 0
-                    vol_details = getVolDetails(headers, [], vars.fsxList[fsxs]['fsxMgmtIp'])
-                    for vol in vol_details:
-                        if(vol['guarantee'] == "volume"):
-                            sc_space_used += vol['space_total']
-                        else:
-                            sc_space_used += (vol['space_used'])
-                    
-                    if(response_vol.json()['guarantee']['type'] == "volume"):
-                        sc_space_used = sc_space_used - response_vol.json()['space']['size'] + new_vol_size
-                    else:
-                        sc_space_used = sc_space_used - response_vol.json()['space']['used'] + new_vol_size
-                    sc_space_used = sc_space_used/(1024*1024*1024)
-                    #update vol size if sc can accomodate
-                    if(float(sc_space_used * 1.1) < float(aggr_total)):
-                        #update vol
-                        all_vol_details = client_fsx.describe_volumes()
-                        for vol in all_vol_details['Volumes']:
-                            if(vol['OntapConfiguration']['UUID'] == response_vol.json()['uuid']):
-                                vol_id = vol['VolumeId']
-                        try:
-                            update = client_fsx.update_volume(VolumeId = vol_id, OntapConfiguration = {'SizeInMegabytes': new_vol_size_mb})
-                        except botocore.exceptions.ClientError as e:
-                            logger.error(e.response['Error']['Message'])
-                        try:
-                            url_job_monitor = "https://{}/api/cluster/jobs/{}".format(vars.fsxList[fsxs]['fsxMgmtIp'], update['ResponseMetadata']['RequestId'])
-                            job_status = 0
-                            while(job_status not in ["success", "failure"] and int(update['ResponseMetadata']['HTTPStatusCode']) not in range(200,300)):
-                                response_job_monitor = requests.get(url_job_monitor, headers=headers, verify=False)
-                                job_status = response_job_monitor.json()['state']
-                                if job_status == "failure":
-                                    logger.info("Failure in updating volume: {}".format(response_job_monitor.json()["error"]["message"]))
-                                if response_job_monitor.status_code not in range(200, 300):
-                                    raise Exception(f"Failed to update Volume size. Status code: {response_job_monitor.status_code}, Response: {response_job_monitor.text}")
-                                time.sleep(5)
-                        except Exception as e:
-                            logger.error("An error occurred while updating the Volume size:", e)
-                        
-                        if job_status == "success":
-                            log = "Volume space used for volume {} is greater than {}%. Volume resized to: {} GB".format(response_vol.json()['name'], vars.fsxList[fsxs]['resize_threshold'], round(new_vol_size_mb/1024,2))
-                            logger.info(log)
-                            email_requirements.append(
-                                {
-                                    "case": "vol",
-                                    "name": response_vol.json()['name'],
-                                    "use_per": round(vol_per,2),
-                                    "new_size": new_vol_size_mb,
-                                    "warn": False
-                                }
-                            )
-                    #update sc followed by vol
-                    else:
-                        #update sc
-                        size = float(storage_capacity) * 1.1
-                        while float(size) < float(sc_space_used):
-                            size = size * 1.1
-                        size = math.ceil(size)
-                        try:
-                            update = client_fsx.update_file_system(FileSystemId = vars.fsxList[fsxs]['fsxId'], StorageCapacity = size)
-                        except botocore.exceptions.ClientError as e:
-                            logger.error(e.response['Error']['Message'])
-                        log = "Volume {} needs to be resized. However Storage capacity is out of space. Hence, File System Storage Capacity resized to: {} GB".format(response_vol.json()['name'], size)
-                        logger.info(log)
-                        email_requirements.append(
-                            {
-                                "case": "sc",
-                                "name": response_vol.json()['name'],
-                                "use_per": vars.fsxList[fsxs]['resize_threshold'],
-                                "new_size": size,
-                                "warn": True
-                            }
-                        )
+def processStorageCapacity(state, email_requirements):
+    fsx = state['fsx']
+    storage_capacity = state['storage_capacity']
+    aggr_total = state['aggr_total']
 
-                        #update vol
-                        # all_vol_details = client_fsx.describe_volumes()
-                        # for vol in all_vol_details['Volumes']:
-                        #     if(vol['OntapConfiguration']['UUID'] == response_vol.json()['uuid']):
-                        #         vol_id = vol['VolumeId']
-                        # update = client_fsx.update_volume(VolumeId = vol_id, OntapConfiguration = {'SizeInMegabytes': new_vol_size_mb})
-                        # log = "Volume space used for volume {} is greater than {}%. Volume resized to: {} GB".format(response_vol.json()['name'], vars.resize_threshold, round(new_vol_size_mb/1024,2))
-                        # sendEmail("vol", response_vol.json()['name'], vars.resize_threshold, new_vol_size_mb)
-                        # logger.info(log)
-                #thin provisioned volume
-                else:
-                    logger.info("Preparing to update volume: thin provisioned volume")
-                    #update vol
-                    all_vol_details = client_fsx.describe_volumes()
-                    for vol in all_vol_details['Volumes']:
-                        if(vol['OntapConfiguration']['UUID'] == response_vol.json()['uuid']):
-                            vol_id = vol['VolumeId']
-                    try:
-                        update = client_fsx.update_volume(VolumeId = vol_id, OntapConfiguration = {'SizeInMegabytes': new_vol_size_mb})
-                    except botocore.exceptions.ClientError as e:
-                        logger.error(e.response['Error']['Message'])
-                    try:
-                        url_job_monitor = "https://{}/api/cluster/jobs/{}".format(vars.fsxList[fsxs]['fsxMgmtIp'], update['ResponseMetadata']['RequestId'])
-                        job_status = 0
-                        while(job_status not in ["success", "failure"] and int(update['ResponseMetadata']['HTTPStatusCode']) not in range(200,300)):
-                            response_job_monitor = requests.get(url_job_monitor, headers=headers, verify=False)
-                            job_status = response_job_monitor.json()['state']
-                            if job_status == "failure":
-                                logger.info("Failure in updating volume: {}".format(response_job_monitor.json()["error"]["message"]))
-                            if response_job_monitor.status_code not in range(200, 300):
-                                raise Exception(f"Failed to update Volume size. Status code: {response_job_monitor.status_code}, Response: {response_job_monitor.text}")
-                            time.sleep(5)
-                    except Exception as e:
-                        logger.error("An error occurred while updating the Volume size: %s", e)
-                    
-                    if job_status == "success":
-                        log = "Volume space used for volume {} is greater than {}%. Volume resized to: {} GB".format(response_vol.json()['name'], vars.fsxList[fsxs]['resize_threshold'], round(new_vol_size_mb/1024,2))
-                        logger.info(log)
-                        email_requirements.append(
-                            {
-                                "case": "vol",
-                                "name": response_vol.json()['name'],
-                                "use_per": round(vol_per,2),
-                                "new_size": new_vol_size_mb,
-                                "warn": False
-                            }
-                        )
-                
-            else:
-                log = "Volume space used by volume {} is less than {}%. Volume Size Used = {}%".format(response_vol.json()['name'], vars.fsxList[fsxs]['resize_threshold'], round(vol_per,2))
-                logger.info(log)
-        
-        
-        #calculate % storage capacity used
-        logger.info("Calculating storage capacity used")
-        total_space_used = 0
-        for vol in vol_details:
-            if(vol['guarantee'] == "volume"):
-                total_space_used += vol['space_total']
+    #calculate % storage capacity used
+    logger.info("Calculating storage capacity used")
+    total_space_used = getStateScSpaceUsed(state)
+    sc_used_per = (float(total_space_used)/float(aggr_total))*100
+
+    if(fsx['warn_notification'] and int(sc_used_per * 1.1) > 75 and int(sc_used_per * 1.1) < int(fsx['resize_threshold'])):
+        email_requirements.append(
+            {
+                "case": "sc_notification",
+                "name": "null",
+                "use_per": fsx['resize_threshold'],
+                "new_size": 0,
+                "warn": False
+            }
+        )
+    if int(sc_used_per * 1.1) > int(fsx['resize_threshold']):
+        size = getNewStorageCapacity(storage_capacity, aggr_total)
+        try:
+            state['client_fsx'].update_file_system(FileSystemId = fsx['fsxId'], StorageCapacity = size)
+        except botocore.exceptions.ClientError as e:
+            logger.error(e.response['Error']['Message'])
+        log = "Total volume space used is greater than {}%. File System Storage Capacity resized to: {} GB".format(fsx['resize_threshold'],size)
+        logger.info(log)
+        email_requirements.append(
+            {
+                "case": "sc",
+                "name": "null",
+                "use_per": fsx['resize_threshold'],
+                "new_size": size,
+                "warn": False
+            }
+        )
+    else:
+        log = "Total volume space used is less than {}%. Storage Capacity = {} GB, Total volume Size Used = {}%".format(fsx['resize_threshold'], storage_capacity, round(sc_used_per,2))
+        logger.info(log)
+
+def getNewStorageCapacity(storage_capacity, aggr_total):
+    #storage capacity grown by 10% of the aggregate, at least 10% of the current capacity
+    size = float(aggr_total) * 1.1
+    size = float(storage_capacity) + (float(size) - float(aggr_total))
+    if(float(size) < 1.1*float(storage_capacity)):
+        size = float(storage_capacity) * 1.1
+        while float(size) < float(storage_capacity):
+            size *= 1.1
+    return math.ceil(size)
+
+def processSnapshots(state, vol, email_requirements):
+    policy = getObjectPolicy(state, vol['svm'], vol['name'])
+    #snapshots listed ahead of the deletions are not listed again
+    expired = None
+    if vol['uuid'] in state['expired_snapshots']:
+        try:
+            expired = state['expired_snapshots'].pop(vol['uuid']).result()
+        except Exception as e:
+            logger.error("Failed to list snapshots of volume %s: %s", vol['name'], e)
+    if expired is None:
+        expired = getExpiredSnapshots(state, vol, policy)
+    #snapshots deleted to reclaim space are already gone
+    expired = [snapshot for snapshot in expired if snapshot['uuid'] not in state['reclaimed_snapshots']]
+    if vars.enable_bulk_snapshot_deletion:
+        submitBulkSnapshotDeletion(state, vol, policy, expired)
+        return True
+
+    #the listing is closed before the deletions so no response stays open while jobs are polled
+    clone_parents = set(volume['parent_snapshot'] for volume in getCloneVolumes(state))
+    for i, snapshot in enumerate(expired):
+        if deadlineReached(state['context']):
+            logger.info("Deadline approaching. Deferring deletion of %d snapshots of volume %s", len(expired) - i, vol['name'])
+            return False
+        if snapshot['name'] not in clone_parents:
+            deleteSnapshot(state, snapshot, policy, email_requirements)
+    return True
+
+def getExpiredSnapshots(state, vol, policy, context=None):
+    #returns the snapshots older than the threshold, FlexClone parents are kept in the state for the report
+    fsx = state['fsx']
+    if deadlineReached(context):
+        return None
+    logger.info("Preparing to fetch Snapshot details for volume %s", vol['name'])
+    clone_parents = set(volume['parent_snapshot'] for volume in getCloneVolumes(state))
+    expired = []
+    for snapshot in iterSnapshotSummaries(state['headers'], fsx['fsxMgmtIp'], vol):
+        if snapshot['name'] in clone_parents:
+            state['snapshot_details'].append(snapshot)
+
+        try:
+            # Extract the create-time value
+            logger.info("Extracting the create-time value from the snapshot details")
+            create_time_str = snapshot["create_time"]
+            create_time = datetime.fromisoformat(create_time_str.replace('Z', '+00:00'))
+
+            # Calculate how old the snapshot is in days
+            age_days = (datetime.now(timezone.utc) - create_time).days
+            snapshot["age_in_days"] = int(age_days)
+
+        except ValueError as e:
+            logger.error(f"Error parsing create-time value: {create_time_str}")
+
+        try:
+            # Extract the size value from the snapshot details
+            logger.info("Extracting the size value from the snapshot details")
+            size_bytes = snapshot["size"]
+            snapshot["size_in_bytes"] = size_bytes
+
+            #delete snapshot if older than threshold
+            logger.info("Preparing to delete snapshot if older than threshold")
+            if(int(snapshot["age_in_days"]) > policy['snapshot_age_threshold_in_days']):
+                expired.append(snapshot)
+
+        except Exception as e:
+            logger.error("Error while fetching size value: %s", e)
+    return expired
+
+def submitBulkSnapshotDeletion(state, vol, policy, old_snapshots):
+    #delete all expired snapshots of a volume with a single query-based collection DELETE
+    fsx = state['fsx']
+    logger.info("Preparing bulk deletion of expired snapshots for volume %s", vol['name'])
+
+    #snapshots older than the threshold by whole days, same as the one by one deletion
+    cutoff = datetime.now(timezone.utc).replace(microsecond=0) - timedelta(days=policy['snapshot_age_threshold_in_days'] + 1)
+    clone_parents = set(volume['parent_snapshot'] for volume in getCloneVolumes(state))
+    expired = []
+    protected = []
+    for snapshot in old_snapshots:
+        #the snapshots may have been listed a while ago, only those matched by the DELETE query are reported
+        create_time = datetime.fromisoformat(snapshot["create_time"].replace('Z', '+00:00'))
+        if create_time <= cutoff:
+            if snapshot['name'] in clone_parents:
+                protected.append(snapshot)
             else:
-                total_space_used += vol['space_used']
-        total_space_used = total_space_used/(1024*1024*1024)
-        sc_used_per = (float(total_space_used)/float(aggr_total))*100
+                expired.append(snapshot)
+    if not expired:
+        return
 
-        if(vars.fsxList[fsxs]['warn_notification'] and int(sc_used_per * 1.1) > 75 and int(sc_used_per * 1.1) < int(vars.fsxList[fsxs]['resize_threshold'])):
-            email_requirements.append(
+    #ONTAP queries cannot AND several exclusions, more than one clone parent falls back to a uuid list.
+    #a snapshot ONTAP refuses to delete does not stop the deletion of the others
+    query = {"create_time": "<=" + cutoff.isoformat(), "return_timeout": 0, "continue_on_failure": "true"}
+    batches = [(query, expired)]
+    if len(protected) == 1:
+        query["name"] = "!" + protected[0]['name']
+    elif len(protected) > 1:
+        batches = []
+        for i in range(0, len(expired), vars.bulk_snapshot_deletion_batch_size):
+            batch = expired[i:i+vars.bulk_snapshot_deletion_batch_size]
+            batches.append((dict(query, uuid="|".join(snapshot['uuid'] for snapshot in batch)), batch))
+
+    url = "https://{}/api/storage/volumes/{}/snapshots".format(fsx['fsxMgmtIp'], vol['uuid'])
+    for params, batch in batches:
+        try:
+            response_ss_delete = ontap_session.delete(url, headers=state['headers'], params=params, verify=False)
+            if response_ss_delete.status_code not in range(200, 300):
+                raise Exception("Status code: %d, Response: %s" % (response_ss_delete.status_code, response_ss_delete.text))
+            state['snapshot_jobs'].append(
                 {
-                    "case": "sc_notification",
-                    "name": "null",
-                    "use_per": vars.fsxList[fsxs]['resize_threshold'],
-                    "new_size": 0,
-                    "warn": False
+                    "vol_name": vol['name'],
+                    "vol_uuid": vol['uuid'],
+                    "cutoff": cutoff.isoformat(),
+                    "job_uuid": response_ss_delete.json()['job']['uuid'],
+                    "snapshots": batch,
+                    "state": "running"
                 }
             )
-        if int(sc_used_per * 1.1) > int(vars.fsxList[fsxs]['resize_threshold']):
-            size = float(aggr_total) * 1.1
-            size = float(storage_capacity) + (float(size) - float(aggr_total))
-            if(float(size) < 1.1*float(storage_capacity)):
-                size = float(storage_capacity) * 1.1
-                while float(size) < float(storage_capacity):
-                    size *= 1.1 
-            size = math.ceil(size)
+        except Exception as e:
+            logger.error("An error occurred while deleting expired snapshots of volume %s: %s", vol['name'], e)
+
+def waitForSnapshotJobs(state, context, email_requirements):
+    fsx = state['fsx']
+    pending = list(state['snapshot_jobs'])
+    while pending:
+        running = []
+        for job in pending:
             try:
-                update = client_fsx.update_file_system(FileSystemId = vars.fsxList[fsxs]['fsxId'], StorageCapacity = size)
-            except botocore.exceptions.ClientError as e:
-                logger.error(e.response['Error']['Message'])
-            log = "Total volume space used is greater than {}%. File System Storage Capacity resized to: {} GB".format(vars.fsxList[fsxs]['resize_threshold'],size)
-            logger.info(log)
-            email_requirements.append(
-                {
-                    "case": "sc",
-                    "name": "null",
-                    "use_per": vars.fsxList[fsxs]['resize_threshold'],
-                    "new_size": size,
-                    "warn": False
-                }
-            )
-        
-        else:
-            log = "Total volume space used is less than {}%. Storage Capacity = {} GB, Total volume Size Used = {}%".format(vars.fsxList[fsxs]['resize_threshold'], storage_capacity, round(sc_used_per,2))
-            logger.info(log)
+                url_job_monitor = "https://{}/api/cluster/jobs/{}".format(fsx['fsxMgmtIp'], job['job_uuid'])
+                response_job_monitor = ontap_session.get(url_job_monitor, headers=state['headers'], verify=False)
+                if response_job_monitor.status_code not in range(200, 300):
+                    raise Exception("Status code: %d, Response: %s" % (response_job_monitor.status_code, response_job_monitor.text))
+                job['state'] = response_job_monitor.json()['state']
+                if job['state'] == "failure":
+                    logger.info("Failure in deleting expired snapshots of volume %s: %s", job['vol_name'], response_job_monitor.json()["error"]["message"])
+            except Exception as e:
+                logger.error("An error occurred while monitoring snapshot deletion of volume %s: %s", job['vol_name'], e)
+                job['state'] = "failure"
+            if job['state'] not in ["success", "failure"]:
+                running.append(job)
+        pending = running
+        if pending:
+            if deadlineReached(context):
+                logger.info("Deadline approaching. %d snapshot deletion jobs are still running", len(pending))
+                break
+            time.sleep(5)
 
-        
-        #Get snapshot details
-        logger.info("Preparing to fetch Snapshot details")
-        if(vars.fsxList[fsxs]['enable_snapshot_deletion']):
-            snapshot_details = getSnapshotDetails(headers, vol_details, vars.fsxList[fsxs]['fsxMgmtIp'], snapshot_details)
-            for snapshot in snapshot_details:
-                snapshot_name_not_present = True
-                for volume in vol_details:
-                    if volume['parent_snapshot'] == snapshot['name']:
-                        snapshot_name_not_present = False
-                        break
+    #report one row per volume, a failed job may still have deleted part of its snapshots
+    vol_jobs = {}
+    for job in state['snapshot_jobs']:
+        vol_jobs.setdefault(job['vol_uuid'], []).append(job)
+    summaries = []
+    for vol_uuid, jobs in vol_jobs.items():
+        vol = {"name": jobs[0]['vol_name'], "uuid": vol_uuid}
+        snapshots = [snapshot for job in jobs for snapshot in job['snapshots']]
+        #the snapshots still listed up to the cutoff were not deleted
+        try:
+            remaining = set(snapshot['uuid'] for snapshot in iterSnapshotSummaries(state['headers'], fsx['fsxMgmtIp'], vol, {"create_time": "<=" + jobs[0]['cutoff']}))
+        except Exception as e:
+            logger.error("An error occurred while listing the remaining snapshots of volume %s: %s", vol['name'], e)
+            remaining = set(snapshot['uuid'] for job in jobs if job['state'] != "success" for snapshot in job['snapshots'])
+        deleted = [snapshot for snapshot in snapshots if snapshot['uuid'] not in remaining]
+        if any(job['state'] not in ["success", "failure"] for job in jobs):
+            status = "In Progress"
+        elif len(deleted) == len(snapshots):
+            status = "Deleted"
+        elif deleted:
+            status = "Partially Deleted"
+        else:
+            status = "Failed"
+        summaries.append({"vol_name": vol['name'], "count": len(deleted), "size_in_bytes": sum(int(snapshot['size']) for snapshot in deleted), "status": status})
+    for summary in summaries:
+        log = "%d expired snapshots of volume %s have been deleted freeing %d bytes. Status: %s" % (summary['count'], summary['vol_name'], summary['size_in_bytes'], summary['status'])
+        logger.info(log)
+        email_requirements.append(
+            {
+                "case": "snapshot_bulk_delete",
+                "name": summary,
+                "use_per": summary['vol_name'],
+                "new_size": summary['count'],
+                "warn": summary['status'] != "Deleted"
+            }
+        )
 
-                try:
-                    # Extract the create-time value
-                    logger.info("Extracting the create-time value from the snapshot details")
-                    create_time_str = snapshot["create_time"]
-                    create_time = datetime.fromisoformat(create_time_str.replace('Z', '+00:00'))
-
-                    # Calculate how old the snapshot is in days
-                    age_days = (datetime.now(timezone.utc) - create_time).days
-                    snapshot["age_in_days"] = int(age_days)
-                        
-                except ValueError as e:
-                    logger.error(f"Error parsing create-time value: {create_time_str}")
-                    
-                try:
-                    # Extract the size value from the snapshot details
-                    logger.info("Extracting the size value from the snapshot details")
-                    size_bytes = snapshot["size"]
-                    snapshot["size_in_bytes"] = size_bytes
-
-                    #delete snapshot if older than threshold
-                    logger.info("Preparing to delete snapshot if older than threshold")
-                    if(int(snapshot["age_in_days"]) > vars.fsxList[fsxs]['snapshot_age_threshold_in_days'] and snapshot_name_not_present):
-                        url = "https://{}/api/storage/volumes/{}/snapshots/{}".format(vars.fsxList[fsxs]['fsxMgmtIp'], snapshot["vol_uuid"], snapshot["uuid"])
-                        try:
-                            response_ss_delete = requests.delete(url, headers=headers, verify=False)
-                        except Exception as e:
-                            logger.error(f"An error occurred while deleting the Snapshot: {e}")
-                        try:
-                            url_job_monitor = "https://{}/api/cluster/jobs/{}".format(vars.fsxList[fsxs]['fsxMgmtIp'], response_ss_delete.json()['job']['uuid'])
-                            job_status = 0
-                            while(job_status not in ["success", "failure"]):
-                                response_job_monitor = requests.get(url_job_monitor, headers=headers, verify=False)
-                                job_status = response_job_monitor.json()['state']
-                                if job_status == "failure":
-                                    logger.info("Failure in deleting snapshot %s: %s", snapshot['name'], response_job_monitor.json()["error"]["message"])
-                                if response_job_monitor.status_code not in range(200, 300):
-                                    raise Exception("Failed to delete Snapshot %s. Status code: %d, Response: %s" % (snapshot['name'], response_job_monitor.status_code, response_job_monitor.text))
-                                time.sleep(5)
-                        except Exception as e:
-                            logger.error("An error occurred while deleting the Snapshot %s: %s", snapshot["name"], e)
-                        
-                        if job_status == "success":
-                            log = "Snapshot %s for volume %s has been deleted as it is %d days old which is above the threshold of %d days." % (snapshot['name'], snapshot['vol_name'], int(snapshot['age_in_days']), vars.fsxList[fsxs]['snapshot_age_threshold_in_days'])
-                            logger.info(log)
-                            email_requirements.append(
-                                {
-                                    "case": "snapshot_delete",
-                                    "name": snapshot,
-                                    "use_per": snapshot["vol_name"],
-                                    "new_size": int(age_days),
-                                    "warn": False
-                                }
-                            )
-
-                except Exception as e:
-                    logger.error("Error while fetching size value: %s", e)
-        
-        #populate flexclone details
-        logger.info("Populating flexclone details")
-        for vol in vol_details:
-            if(vol["is_flexclone"]):
-                for snapshot in snapshot_details:
-                    if(vol["parent_snapshot"] == snapshot["name"]):
-                        clone_vol_details.append(
-                            {
-                                "name": snapshot["vol_name"],
-                                "parent_snapshot": vol["parent_snapshot"],
-                                "snapshot_size": float(snapshot["size_in_bytes"])/1024
-                            }
-                        )
-        
-    #send consolidated email
+def deleteSnapshot(state, snapshot, policy, email_requirements):
+    fsx = state['fsx']
+    headers = state['headers']
+    url = "https://{}/api/storage/volumes/{}/snapshots/{}".format(fsx['fsxMgmtIp'], snapshot["vol_uuid"], snapshot["uuid"])
+    job_status = 0
+    try:
+        response_ss_delete = ontap_session.delete(url, headers=headers, verify=False)
+    except Exception as e:
+        logger.error(f"An error occurred while deleting the Snapshot: {e}")
+    try:
+        url_job_monitor = "https://{}/api/cluster/jobs/{}".format(fsx['fsxMgmtIp'], response_ss_delete.json()['job']['uuid'])
+        while(job_status not in ["success", "failure"]):
+            if deadlineReached(state['context']):
+                logger.info("Deadline approaching. Not waiting for the deletion job of snapshot %s", snapshot['name'])
+                break
+            response_job_monitor = ontap_session.get(url_job_monitor, headers=headers, verify=False)
+            job_status = response_job_monitor.json()['state']
+            if job_status == "failure":
+                logger.info("Failure in deleting snapshot %s: %s", snapshot['name'], response_job_monitor.json()["error"]["message"])
+            if response_job_monitor.status_code not in range(200, 300):
+                raise Exception("Failed to delete Snapshot %s. Status code: %d, Response: %s" % (snapshot['name'], response_job_monitor.status_code, response_job_monitor.text))
+            time.sleep(5)
+    except Exception as e:
+        logger.error("An error occurred while deleting the Snapshot %s: %s", snapshot["name"], e)
 
+    if job_status == "success":
+        log = "Snapshot %s for volume %s has been deleted as it is %d days old which is above the threshold of %d days." % (snapshot['name'], snapshot['vol_name'], int(snapshot['age_in_days']), policy['snapshot_age_threshold_in_days'])
+        logger.info(log)
+        email_requirements.append(
+            {
+                "case": "snapshot_delete",
+                "name": snapshot,
+                "use_per": snapshot["vol_name"],
+                "new_size": int(snapshot['age_in_days']),
+                "warn": False
+            }
+        )
 
-    sendEmail(email_requirements, clone_vol_details)
+#cases that report a condition rather than an action, they repeat on every run until the condition clears
+WARNING_CASES = ["lun_notification", "vol_notification", "sc_notification", "lun_max_size", "vol_max_size", "deferred"]
 
-    return {
-        'statusCode': 200,
-        'body': "success"
-    }
+def isRepeatedNotification(email_requirements, clone_vol_details, notified):
+    #an email with no action and the same warnings as the previous one adds nothing, the usage percentage is ignored
+    warnings = set((email['case'], str(email['name'])) for email in email_requirements if email['case'] in WARNING_CASES)
+    warnings |= set(("clone", clone['name'], clone['parent_snapshot']) for clone in clone_vol_details)
+    actions = [email for email in email_requirements if email['case'] not in WARNING_CASES]
+    repeated = not actions and warnings == notified.get('warnings')
+    notified['warnings'] = warnings
+    if repeated:
+        logger.info("Skipping the Email. The %d warnings are unchanged since the previous run", len(warnings))
+    return repeated
 
 def sendEmail(email_requirements, clone_vol_details):
     logger.info("Preparing to send an Email")
@@ -776,7 +1970,9 @@ def sendEmail(email_requirements, clone_vol_details):
     vol_output_str = []
     sc_output_str = []
     snapshot_output_str = []
+    snapshot_bulk_output_str = []
     clone_output_str = []
+    deferred_output_str = []
     output_html = ["<h1>FSx for ONTAP Monitoring</h1><br>"]
     
     
@@ -830,14 +2026,26 @@ def sendEmail(email_requirements, clone_vol_details):
             sc_output_str.append("<p class='card-text'>Storage Capacity used is greater than {}%. File System Storage Capacity resized to: {} GB</p>".format(use_per , new_size))
         elif(case == "sc" and warn == True):
             sc_output_str.append("<p class='card-text'>Volume {} needs to be resized. However Storage capacity is out of space. Hence, File System Storage Capacity resized to: {} GB. Please run the automation again to update the volume once storage capacity update is completed successfully.</p>".format(name, new_size))
+        elif(case == "lun_max_size"):
+            lun_output_str.append("<tr><td>{}</td><td>{}%</td><td style='color: orange;'>{}</td><td></td></tr>".format(name, use_per, "Max Size Reached"))
+        elif(case == "vol_autosize"):
+            vol_output_str.append("<tr><td>{}</td><td>{}%</td><td style='color: green;'>{}</td><td>{}GB max</td></tr>".format(name, use_per, "Autosize Configured", round(new_size/(1024*1024*1024),2)))
+        elif(case == "vol_reclaim"):
+            vol_output_str.append("<tr><td>{}</td><td>{}%</td><td style='color: red;'>{}</td><td>{}GB freed</td></tr>".format(name, use_per, "Snapshots Deleted", round(new_size/(1024*1024*1024),2)))
+        elif(case == "vol_max_size"):
+            vol_output_str.append("<tr><td>{}</td><td>{}%</td><td style='color: orange;'>{}</td><td></td></tr>".format(name, use_per, "Max Size Reached"))
         elif(case == "lun_notification"):
             lun_output_str.append("<tr><td>{}</td><td>{}%</td><td style='color: orange;'>{}</td><td></td></tr>".format(name, use_per, "Warning"))
         elif(case == "vol_notification"):
             vol_output_str.append("<tr><td>{}</td><td>{}%</td><td style='color: orange;'>{}</td><td></td></tr>".format(name, use_per, "Warning"))
         elif(case == "sc_notification"):
             sc_output_str.append("<p class='card-text'>Storage Capacity used is greater than 75%. File System Storage Capacity will be resized once it crosses {}%</p>".format(use_per))
+        elif(case == "deferred"):
+            deferred_output_str.append("<p class='card-text'>Execution time limit was reached before all checks could run. {} unfinished work items have been saved and will be resumed on the next run.</p>".format(new_size))
         elif(case == "snapshot_delete"):
             snapshot_output_str.append("<tr><td>{}</td><td>{}</td><td>{} day</td><td>{}KB</td><td style='color: red;'>{}</td></tr>".format(name["name"], use_per, new_size, int(int(name["size_in_bytes"])/1024), "Deleted"))
+        elif(case == "snapshot_bulk_delete"):
+            snapshot_bulk_output_str.append("<tr><td>{}</td><td>{}</td><td>{}KB</td><td style='color: {};'>{}</td></tr>".format(use_per, new_size, int(int(name["size_in_bytes"])/1024), "orange" if warn else "red", name["status"]))
     
     if(len(clone_vol_details)):
         #add clone vol details to output string
@@ -848,6 +2056,10 @@ def sendEmail(email_requirements, clone_vol_details):
             
         clone_output_str.append("</tbody></table></div></div></div>")
     
+    if len(deferred_output_str):
+        output_html.append("<div class='card mb-3'><div class='card-body'><h5 class='card-title'>Execution Notification</h5>")
+        output_html += deferred_output_str
+        output_html.append("</div></div></div>")
     if len(sc_output_str):
         output_html.append("<div class='card mb-3'><div class='card-body'><h5 class='card-title'>File System Storage Capacity Notification</h5>")
         output_html += sc_output_str
@@ -864,6 +2076,10 @@ def sendEmail(email_requirements, clone_vol_details):
         output_html.append("<div class='card mb-3'><div class='card-body'><h5 class='card-title'>Snapshot Notification</h5><div class='table-responsive'><table class='table table-striped'><thead><tr><th>Snapshot Name</th><th>Volume Name</th><th>Snapshot Age</th><th>Space Freed Up</th><th>Status</th></tr></thead><tbody>")
         output_html += snapshot_output_str
         output_html.append("</tbody></table></div></div></div>")
+    if len(snapshot_bulk_output_str):
+        output_html.append("<div class='card mb-3'><div class='card-body'><h5 class='card-title'>Snapshot Expiry Notification</h5><div class='table-responsive'><table class='table table-striped'><thead><tr><th>Volume Name</th><th>Snapshots Deleted</th><th>Space Freed Up</th><th>Status</th></tr></thead><tbody>")
+        output_html += snapshot_bulk_output_str
+        output_html.append("</tbody></table></div></div></div>")
     if len(clone_output_str):
         output_html += clone_output_str
         
@@ -871,7 +2087,7 @@ def sendEmail(email_requirements, clone_vol_details):
     
     SUBJECT = "FSX for ONTAP Monitoring Notification: AWS Lambda"
     
-    if len(clone_vol_details) or len(sc_output_str) or len(vol_output_str) or len(lun_output_str) or len(snapshot_output_str) or len(clone_output_str):
+    if len(clone_vol_details) or len(sc_output_str) or len(vol_output_str) or len(lun_output_str) or len(snapshot_output_str) or len(clone_output_str) or len(deferred_output_str) or len(snapshot_bulk_output_str):
         if vars.internet_access == False:
             
             ssm = boto3.client('ssm')
@@ -955,63 +2171,46 @@ def getStorageCapacity(client_fsx, fsxId):
     except botocore.exceptions.ParamValidationError as error:
         logger.error("The parameters you provided are incorrect: {}".format(error))
 
-def getVolDetails(headers, vol_details, fsxMgmtIp):
+def getVolDetails(headers, vol_details, fsxMgmtIp, context=None, query=None, policy_matcher=None):
     logger.info("Fetching Volume Details")
-    url = "https://{}/api/storage/volumes".format(fsxMgmtIp)
-    response = requests.get(url, headers=headers, verify=False)
-    
-    for i in range(len(response.json()['records'])):
-        temp = response.json()['records'][i]['uuid']
-        url = "https://{}/api/storage/volumes/{}?fields=*,guarantee,clone.is_flexclone,clone.parent_snapshot.name".format(fsxMgmtIp,temp)
-        response_vol = requests.get(url, headers=headers, verify=False)
-        if(response_vol.json()["clone"]["is_flexclone"]):
-            vol_details.append(
-                {
-                    "name": response_vol.json()['name'], 
-                    "uuid": response.json()['records'][i]['uuid'],
-                    "space_total": response_vol.json()['space']['size'],
-                    "space_used": response_vol.json()['space']['size'] - response_vol.json()['space']['available'],
-                    "guarantee": response_vol.json()['guarantee']['type'],
-                    "is_flexclone": True,
-                    "parent_snapshot": response_vol.json()['clone']['parent_snapshot']['name']
-                }
-            )
-        else:
-            vol_details.append(
-                {
-                    "name": response_vol.json()['name'], 
-                    "uuid": response.json()['records'][i]['uuid'],
-                    "space_total": response_vol.json()['space']['size'],
-                    "space_used": response_vol.json()['space']['size'] - response_vol.json()['space']['available'],
-                    "guarantee": response_vol.json()['guarantee']['type'],
-                    "is_flexclone": False,
-                    "parent_snapshot": ""
-                }
-            )
+    #the listing carries every field needed, volumes are not fetched one by one
+    for values in iterOntapRecords(headers, fsxMgmtIp, "/api/storage/volumes", VOL_FIELDS, query):
+        vol = getVolFromRecord(values)
+        if policy_matcher and policy_matcher(vol['svm'], vol['name'])['exclude']:
+            continue
+        if deadlineReached(context):
+            logger.info("Deadline approaching. Volume inventory is incomplete")
+            break
+        vol_details.append(vol)
     return vol_details
 
-def getSnapshotDetails(headers, vol_details, fsxMgmtIp, snapshot_details):
-    logger.info("Fetching Snapshot Details")
-    snapshot_details = []
-    for vol in vol_details:
-        url = "https://{}/api/storage/volumes/{}/snapshots".format(fsxMgmtIp, vol["uuid"])
-        response_snapshots = requests.get(url, headers=headers, verify=False)
-        for snapshot in response_snapshots.json()["records"]:
-            # Fetch detailed snapshot information
-            snapshot_url = "https://{}/api/storage/volumes/{}/snapshots/{}".format(fsxMgmtIp, vol["uuid"], snapshot["uuid"])
-            try:
-                response_snapshot_detail = requests.get(snapshot_url, headers=headers, verify=False)
-                snapshot_info = response_snapshot_detail.json()
-                snapshot_details.append(
-                    {
-                        "name": snapshot["name"],
-                        "uuid": snapshot["uuid"],
-                        "vol_name": vol["name"],
-                        "vol_uuid": vol["uuid"],
-                        "create_time": snapshot_info["create_time"],
-                        "size": snapshot_info["size"]
-                    }
-                )
-            except Exception as e:
-                logger.error("Failed to fetch snapshot details: %s", e)
-    return snapshot_details
+def getVolDetail(headers, fsxMgmtIp, vol_uuid):
+    url = "https://{}/api/storage/volumes/{}".format(fsxMgmtIp, vol_uuid)
+    response_vol = ontap_session.getCached(url, headers, {"fields": ",".join(VOL_FIELDS)})
+    record = response_vol.json()
+    return getVolFromRecord(tuple(getRecordField(record, field.split(".")) for field in VOL_FIELDS))
+
+def iterSnapshotSummaries(headers, fsxMgmtIp, vol, query=None):
+    #streams the snapshots of a volume, callers keep only the ones they act on
+    logger.info("Fetching Snapshot Summaries for volume %s", vol["name"])
+    path = "/api/storage/volumes/{}/snapshots".format(vol["uuid"])
+    for uuid, name, create_time, size in iterOntapRecords(headers, fsxMgmtIp, path, SNAPSHOT_FIELDS, query):
+        yield {
+            "name": name,
+            "uuid": uuid,
+            "vol_name": vol["name"],
+            "vol_uuid": vol["uuid"],
+            "create_time": create_time,
+            "size": size,
+            "size_in_bytes": size
+        }
+
+if __name__ == "__main__":
+    #run locally against an event fixture, e.g. python fsxn_monitoring_resizing_lambda.py events/direct_volume.json
+    import sys
+    logging.basicConfig()
+    local_event = {}
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as f:
+            local_event = json.load(f)
+    print(lambda_handler(local_event, None))
@@ -0,0 +1,232 @@
+# Copyright NetApp 2023. Developed by NetApp Solutions Engineering Team
+#
+# Description:  Long-running service entry point for FSx ONTAP monitoring and auto-resizing.
+#               Runs the same monitoring cycle as the Lambda function on a container or EC2 host.
+#               Each file system is scanned at its own interval while ONTAP connections, AWS clients,
+#               passwords and the fleet configuration stay warm between scans.
+# Pre-requisites for running the service
+#   - Copy fsxn_monitoring_resizing_lambda.py, fleet_config.py, fleet_table.py and vars.py next to this file and update vars.py.
+#   - Install the requests and boto3 packages on the host.
+#   - The host role needs the permissions in policy.json and connectivity to the FSx management endpoints.
+#   - Set "service_scan_interval_in_seconds" or "scan_interval_in_seconds" per file system in the fleet configuration.
+# Usage:
+#   python fsxn_monitoring_service.py
+#   curl http://127.0.0.1:8080/health
+#   curl http://127.0.0.1:8080/metrics
+import json
+import logging
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import vars
+import fsxn_monitoring_resizing_lambda as monitoring
+logger = logging.getLogger()
+
+#scan statistics per file system, shared with the health endpoint
+service_state = {
+    "lock": threading.Lock(),
+    "started_at": time.time(),
+    "config_error": "",
+    "filesystems": {}
+}
+
+#warnings of the last email per file system, a scan only emails again when they change or an action was taken
+notifications = {}
+
+class ScanContext:
+    #stands in for the lambda context so that a scan stops starting new work before its timeout
+    def __init__(self, timeout_in_seconds):
+        self.deadline = time.monotonic() + timeout_in_seconds
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+class HealthHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/health":
+            status_code, body = getHealth()
+            content_type = "application/json"
+        elif self.path == "/metrics":
+            status_code, body = 200, getMetrics()
+            content_type = "text/plain; version=0.0.4"
+        else:
+            status_code, body = 404, "not found"
+            content_type = "text/plain"
+        body = body.encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+def runService():
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    server = startHttpServer()
+
+    clients = None
+    fsx_configs = []
+    refreshed_at = None
+    schedule = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=vars.service_max_concurrent_scans) as pool:
+        while not stop.is_set():
+            now = time.monotonic()
+
+            #new clients drop the cached passwords, running scans keep the clients they started with
+            if refreshed_at is None or now - refreshed_at >= vars.service_refresh_interval_in_seconds:
+                refreshed_at = now
+                clients = monitoring.getAwsClients()
+                fsx_configs = loadFleet(clients, fsx_configs)
+                schedule = {fsx['fsxId']: schedule.get(fsx['fsxId'], now) for fsx in fsx_configs}
+
+            #a file system is never scanned twice at the same time, a late scan starts as soon as the previous one ends
+            for fsx in fsx_configs:
+                if schedule[fsx['fsxId']] <= now and fsx['fsxId'] not in running:
+                    schedule[fsx['fsxId']] = now + getScanInterval(fsx)
+                    running[fsx['fsxId']] = pool.submit(runScan, clients, fsx)
+            for fsxId, future in list(running.items()):
+                if future.done():
+                    del running[fsxId]
+
+            next_run = min(schedule.values(), default=now + 60)
+            stop.wait(max(0.1, min(next_run - now, 1 if running else 60)))
+
+        logger.info("Stopping service. Waiting for %d running scans", len(running))
+    if server:
+        server.shutdown()
+
+def loadFleet(clients, fsx_configs):
+    #keep scanning with the previous configuration when the new one is invalid
+    try:
+        new_configs = monitoring.getFleetConfig(clients['ssm'])
+    except Exception as e:
+        logger.error("Failed to load the fleet configuration: %s", e)
+        with service_state['lock']:
+            service_state['config_error'] = str(e)
+        return fsx_configs
+    with service_state['lock']:
+        service_state['config_error'] = ""
+        service_state['filesystems'] = {fsx['fsxId']: service_state['filesystems'].get(fsx['fsxId'], newScanStats(fsx)) for fsx in new_configs}
+        for fsx in new_configs:
+            service_state['filesystems'][fsx['fsxId']]['interval'] = getScanInterval(fsx)
+    logger.info("Scheduling %d file systems", len(new_configs))
+    return new_configs
+
+def newScanStats(fsx):
+    return {
+        "interval": getScanInterval(fsx),
+        "scans": 0,
+        "failures": 0,
+        "running": False,
+        "last_start": None,
+        "last_duration": None,
+        "last_status": None,
+        "last_success": None
+    }
+
+def getScanInterval(fsx):
+    return fsx.get('scan_interval_in_seconds') or vars.service_scan_interval_in_seconds
+
+def runScan(clients, fsx):
+    #a sweep of the single file system with its own checkpoint, so that unfinished work is resumed by its next scan
+    logger.info("Starting scan of %s", fsx['fsxId'])
+    start = time.time()
+    with service_state['lock']:
+        stats = service_state['filesystems'].setdefault(fsx['fsxId'], newScanStats(fsx))
+        stats['running'] = True
+        stats['last_start'] = start
+    status_code = 500
+    try:
+        response = monitoring.runMonitoringCycle({}, ScanContext(vars.service_scan_timeout_in_seconds), clients, [fsx], notifications.setdefault(fsx['fsxId'], {}), fsx['fsxId'])
+        status_code = response['statusCode']
+    except Exception as e:
+        logger.error("Scan of %s failed: %s", fsx['fsxId'], e)
+    duration = time.time() - start
+    with service_state['lock']:
+        stats['running'] = False
+        stats['scans'] += 1
+        stats['last_duration'] = duration
+        stats['last_status'] = status_code
+        if status_code == 200:
+            stats['last_success'] = time.time()
+        else:
+            stats['failures'] += 1
+    logger.info("Finished scan of %s in %.1f seconds with status %d", fsx['fsxId'], duration, status_code)
+
+def startHttpServer():
+    if not vars.service_http_port:
+        return None
+    server = ThreadingHTTPServer((vars.service_http_address, vars.service_http_port), HealthHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("Health and metrics endpoint listening on %s:%d", vars.service_http_address, vars.service_http_port)
+    return server
+
+def getHealth():
+    #unhealthy when the configuration is invalid or a file system missed more than two scans
+    now = time.time()
+    healthy = True
+    filesystems = {}
+    with service_state['lock']:
+        if service_state['config_error']:
+            healthy = False
+        for fsxId, stats in service_state['filesystems'].items():
+            last_success = stats['last_success'] or service_state['started_at']
+            stale = now - last_success > 3 * stats['interval'] + vars.service_scan_timeout_in_seconds
+            if stale:
+                healthy = False
+            filesystems[fsxId] = {
+                "status": "stale" if stale else "ok",
+                "scans": stats['scans'],
+                "failures": stats['failures'],
+                "running": stats['running'],
+                "last_status": stats['last_status'],
+                "last_duration_in_seconds": stats['last_duration'],
+                "seconds_since_last_success": None if stats['last_success'] is None else round(now - stats['last_success'], 1)
+            }
+        body = {
+            "status": "ok" if healthy else "unhealthy",
+            "config_error": service_state['config_error'],
+            "uptime_in_seconds": round(now - service_state['started_at'], 1),
+            "filesystems": filesystems
+        }
+    return 200 if healthy else 503, json.dumps(body)
+
+def getMetrics():
+    #Prometheus text exposition format
+    metrics = [
+        ("fsxn_monitoring_scans_total", "counter", "Completed scans", lambda stats: stats['scans']),
+        ("fsxn_monitoring_scan_failures_total", "counter", "Scans that did not complete successfully", lambda stats: stats['failures']),
+        ("fsxn_monitoring_scan_running", "gauge", "Whether a scan is running", lambda stats: int(stats['running'])),
+        ("fsxn_monitoring_last_scan_duration_seconds", "gauge", "Duration of the last scan", lambda stats: stats['last_duration']),
+        ("fsxn_monitoring_last_success_timestamp_seconds", "gauge", "Unix time of the last successful scan", lambda stats: stats['last_success']),
+        ("fsxn_monitoring_scan_interval_seconds", "gauge", "Configured interval between scans", lambda stats: stats['interval'])
+    ]
+    lines = []
+    with service_state['lock']:
+        for name, metric_type, description, value in metrics:
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            for fsxId, stats in service_state['filesystems'].items():
+                if value(stats) is not None:
+                    lines.append('{}{{fsx_id="{}"}} {}'.format(name, fsxId, value(stats)))
+        lines.append("# HELP fsxn_monitoring_uptime_seconds Seconds since the service started")
+        lines.append("# TYPE fsxn_monitoring_uptime_seconds gauge")
+        lines.append("fsxn_monitoring_uptime_seconds {}".format(round(time.time() - service_state['started_at'], 1)))
+    #ONTAP response cache shared by all scans
+    for key, value in monitoring.ontap_session.getCacheStats().items():
+        lines.append("# HELP fsxn_monitoring_ontap_cache_{}_total ONTAP response cache {}".format(key, key))
+        lines.append("# TYPE fsxn_monitoring_ontap_cache_{}_total counter".format(key))
+        lines.append("fsxn_monitoring_ontap_cache_{}_total {}".format(key, value))
+    return "\n".join(lines) + "\n"
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(threadName)s %(message)s")
+    runService()
@@ -0,0 +1,388 @@
+# Copyright NetApp 2023. Developed by NetApp Solutions Engineering Team
+#
+# Description:  Offline what-if simulator for tuning the resize and snapshot policies.
+#               "capture" appends the volume, LUN and snapshot inventory of every configured file system
+#               to a compact history file. "simulate" replays the history through the decision logic of the
+#               Lambda function for every combination of the given policy values and reports the resizes,
+#               storage capacity increases, API calls and headroom each combination would have produced.
+# Pre-requisites for running the simulator
+#   - Copy fsxn_monitoring_resizing_lambda.py, fleet_config.py, fleet_table.py and vars.py next to this file.
+#   - Install the requests and boto3 packages, and NumPy for simulating.
+#   - Capturing needs the permissions in policy.json and connectivity to the FSx management endpoints,
+#     e.g. run it from cron next to the service. Simulating runs offline on a copy of the history file.
+# Usage:
+#   python fsxn_monitoring_simulator.py capture history.jsonl.gz --snapshots
+#   python fsxn_monitoring_simulator.py simulate history.jsonl.gz --resize-threshold 80,85,90 --growth-percent 5,10 --snapshot-age-threshold-in-days 7,30
+import argparse
+import csv
+import gzip
+import itertools
+import json
+import logging
+import math
+import os
+import sys
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import vars
+import fleet_config
+import fleet_table
+import fsxn_monitoring_resizing_lambda as monitoring
+logger = logging.getLogger()
+
+#format version of the history records
+HISTORY_VERSION = 1
+#policy values that can be swept, they override the file system settings of the fleet configuration
+SWEEP_KEYS = ["resize_threshold", "growth_percent", "snapshot_age_threshold_in_days", "max_size_in_gb"]
+REPORT_KEYS = ["resizes", "max_size_reached", "warnings", "sc_increases", "sc_added_gb", "snapshot_deletions",
+               "ontap_calls", "aws_calls", "grown_gb", "avg_headroom_gb", "min_free_percent", "out_of_space"]
+
+#history of the current worker process, loaded once by initWorker
+worker_histories = {}
+
+def openHistory(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+def captureFleet(path, with_snapshots):
+    #one record per file system with the columns of every volume, LUN and optionally snapshot
+    clients = monitoring.getAwsClients()
+    fsx_configs = monitoring.getFleetConfig(clients['ssm'])
+    with openHistory(path, "a") as f:
+        for group in monitoring.getFleetGroups(fsx_configs):
+            group_clients = monitoring.getAccountClients(clients, group[0].get('role_arn'), group[0].get('region'))
+            for fsx in group:
+                try:
+                    record = captureFsx(group_clients, fsx, with_snapshots)
+                except Exception as e:
+                    logger.error("Failed to capture %s: %s", fsx['fsxId'], e)
+                    continue
+                if record:
+                    f.write(json.dumps(record, separators=(",", ":")) + "\n")
+                    logger.info("Captured %d volumes and %d LUNs of %s", len(record['vol']['uuid']), len(record['lun']['uuid']), fsx['fsxId'])
+
+def captureFsx(clients, fsx, with_snapshots):
+    fsxn_password = monitoring.getFsxPassword(clients, fsx['fsx_password_ssm_parameter'])
+    if fsxn_password is None:
+        return None
+    headers = monitoring.getOntapHeaders(fsx['username'], fsxn_password)
+    vols = monitoring.getVolDetails(headers, [], fsx['fsxMgmtIp'])
+    luns, _ = monitoring.getLunDetails(headers, fsx['fsxMgmtIp'])
+    record = {
+        "v": HISTORY_VERSION,
+        "time": time.time(),
+        "fsxId": fsx['fsxId'],
+        "storage_capacity": float(monitoring.getStorageCapacity(clients['fsx'], fsx['fsxId'])),
+        "aggr_total": monitoring.getAggrTotal(headers, fsx['fsxMgmtIp']),
+        "vol": {
+            "uuid": [vol['uuid'] for vol in vols],
+            "svm": [vol['svm'] for vol in vols],
+            "name": [vol['name'] for vol in vols],
+            "size": [vol['space_total'] for vol in vols],
+            "used": [vol['space_used'] for vol in vols],
+            "thick": [int(vol['guarantee'] == "volume") for vol in vols]
+        },
+        "lun": {
+            "uuid": [lun['uuid'] for lun in luns],
+            "svm": [lun['svm'] for lun in luns],
+            "vol_name": [lun['vol_name'] for lun in luns],
+            "size": [lun['space_total'] for lun in luns],
+            "used": [lun['space_used'] for lun in luns],
+            "thick": [int(lun['space_reserved'] is True) for lun in luns]
+        }
+    }
+    if with_snapshots:
+        snapshots = {"vol": [], "name": [], "create_time": [], "size": []}
+        for i, vol in enumerate(vols):
+            for snapshot in monitoring.iterSnapshotSummaries(headers, fsx['fsxMgmtIp'], vol):
+                snapshots['vol'].append(i)
+                snapshots['name'].append(snapshot['name'])
+                snapshots['create_time'].append(datetime.fromisoformat(snapshot['create_time'].replace('Z', '+00:00')).timestamp())
+                snapshots['size'].append(snapshot['size'])
+        record['snapshot'] = snapshots
+    return record
+
+def loadHistories(path):
+    #returns {fsxId: history} with the records of each file system indexed by object for fast replay
+    records = {}
+    with openHistory(path, "r") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if record.get("v") != HISTORY_VERSION:
+                    raise ValueError("Unsupported history record version {}".format(record.get("v")))
+                records.setdefault(record['fsxId'], []).append(record)
+    return {fsxId: getHistory(sorted(fsx_records, key=lambda record: record['time'])) for fsxId, fsx_records in records.items()}
+
+def getHistory(records):
+    numpy = fleet_table.numpy
+    #volumes and LUNs share one object index, the first size seen is where the simulation starts
+    objects = {"svm": [], "vol_name": [], "is_lun": [], "thick": [], "size": []}
+    object_index = {}
+    snapshot_index = {}
+    samples = []
+    for record in records:
+        idx = []
+        used = []
+        svm_objects = {}
+        for kind in ["vol", "lun"]:
+            columns = record[kind]
+            names = columns['name'] if kind == "vol" else columns['vol_name']
+            for uuid, svm, name, size, used_space, thick in zip(columns['uuid'], columns['svm'], names, columns['size'], columns['used'], columns['thick']):
+                key = (kind, uuid)
+                if key not in object_index:
+                    object_index[key] = len(object_index)
+                    objects['svm'].append(svm)
+                    objects['vol_name'].append(name)
+                    objects['is_lun'].append(kind == "lun")
+                    objects['thick'].append(bool(thick))
+                    objects['size'].append(float(size))
+                idx.append(object_index[key])
+                used.append(float(used_space))
+                svm_objects.setdefault((kind, svm), 0)
+                svm_objects[(kind, svm)] += 1
+        sample = {
+            "time": record['time'],
+            "storage_capacity": float(record['storage_capacity']),
+            "aggr_total": float(record['aggr_total'] or 0),
+            "idx": numpy.array(idx, dtype=numpy.intp),
+            "used": numpy.array(used),
+            #svm listing, volume and LUN pages per SVM, aggregate listing and detail
+            "listing_calls": 3 + sum(max(1, math.ceil(count / vars.ontap_page_size)) for count in svm_objects.values())
+        }
+        snapshots = record.get('snapshot')
+        if snapshots is not None:
+            vol_uuids = record['vol']['uuid']
+            snapshot_keys = []
+            for vol, name in zip(snapshots['vol'], snapshots['name']):
+                key = (vol_uuids[vol], name)
+                if key not in snapshot_index:
+                    snapshot_index[key] = len(snapshot_index)
+                snapshot_keys.append(snapshot_index[key])
+            sample['snapshot_key'] = numpy.array(snapshot_keys, dtype=numpy.intp)
+            sample['snapshot_vol'] = numpy.array([object_index[("vol", vol_uuids[vol])] for vol in snapshots['vol']], dtype=numpy.intp)
+            sample['snapshot_age'] = record['time'] - numpy.array(snapshots['create_time'], dtype=float)
+            sample['snapshot_size'] = numpy.array(snapshots['size'], dtype=float)
+        samples.append(sample)
+    return {
+        "svm": objects['svm'],
+        "vol_name": objects['vol_name'],
+        "is_lun": numpy.array(objects['is_lun'], dtype=bool),
+        "thick": numpy.array(objects['thick'], dtype=bool),
+        "size": numpy.array(objects['size']),
+        "snapshot_count": len(snapshot_index),
+        "samples": samples
+    }
+
+def getPolicyColumns(history, fsx, overrides):
+    #per object policy of the file system with the swept values applied on file system level
+    numpy = fleet_table.numpy
+    sweep_fsx = dict(fsx, **overrides)
+    get_policy = fleet_config.compilePolicyMatcher(sweep_fsx)
+    policies = [get_policy(svm, vol_name) for svm, vol_name in zip(history['svm'], history['vol_name'])]
+    return sweep_fsx, {
+        "threshold": numpy.array([float(policy['resize_threshold']) for policy in policies]),
+        "growth": numpy.array([1 + float(policy['growth_percent'])/100 for policy in policies]),
+        "warn": numpy.array([bool(policy['warn_notification']) for policy in policies], dtype=bool),
+        "exclude": numpy.array([bool(policy['exclude']) for policy in policies], dtype=bool),
+        "max_size": numpy.array([float(policy['max_size_in_gb'] or 0)*1024*1024*1024 for policy in policies]),
+        "snapshot_deletion": numpy.array([bool(policy['enable_snapshot_deletion']) for policy in policies], dtype=bool),
+        "snapshot_age": numpy.array([float(policy['snapshot_age_threshold_in_days'])*86400 for policy in policies])
+    }
+
+def getTable(size, used, thick, threshold, growth, warn):
+    #fleet_table columns are array buffers
+    return {
+        "size": array('d', size.astype(float).tobytes()),
+        "used": array('d', used.astype(float).tobytes()),
+        "thick": array('b', thick.astype('int8').tobytes()),
+        "threshold": array('d', threshold.astype(float).tobytes()),
+        "growth": array('d', growth.astype(float).tobytes()),
+        "warn": array('b', warn.astype('int8').tobytes())
+    }
+
+def simulateFsx(history, fsx, overrides):
+    #replays the samples of one file system, sizes start at the first capture and only change by simulated resizes
+    numpy = fleet_table.numpy
+    sweep_fsx, policy = getPolicyColumns(history, fsx, overrides)
+    size = history['size'].copy()
+    deleted = numpy.zeros(history['snapshot_count'], dtype=bool)
+    storage_capacity = None
+    result = dict.fromkeys(REPORT_KEYS, 0)
+    result['min_free_percent'] = 100.0
+    headroom_total = 0.0
+
+    for sample in history['samples']:
+        if storage_capacity is None:
+            storage_capacity = sample['storage_capacity']
+        idx = sample['idx']
+        used = sample['used'].copy()
+        ontap_calls = sample['listing_calls']
+        aws_calls = 2
+
+        #snapshots past the swept age would already be deleted, their space is no longer used
+        if 'snapshot_key' in sample:
+            snapshot_vol = sample['snapshot_vol']
+            expired = policy['snapshot_deletion'][snapshot_vol] & ~policy['exclude'][snapshot_vol] & (sample['snapshot_age'] > policy['snapshot_age'][snapshot_vol])
+            credit = numpy.bincount(snapshot_vol[expired], weights=sample['snapshot_size'][expired], minlength=len(size))
+            used = numpy.maximum(0, used - credit[idx])
+            new_deletions = expired & ~deleted[sample['snapshot_key']]
+            deleted[sample['snapshot_key'][new_deletions]] = True
+            result['snapshot_deletions'] += int(new_deletions.sum())
+            if vars.enable_bulk_snapshot_deletion:
+                ontap_calls += 2 * len(numpy.unique(snapshot_vol[new_deletions]))
+            else:
+                ontap_calls += 2 * int(new_deletions.sum())
+        snapshot_vols = ~history['is_lun'][idx] & policy['snapshot_deletion'][idx] & ~policy['exclude'][idx]
+        ontap_calls += int(snapshot_vols.sum())
+
+        #classify the included objects with the decision logic of the Lambda function
+        included = ~policy['exclude'][idx]
+        sel = idx[included]
+        sel_used = used[included]
+        sel_size = size[sel]
+        result['out_of_space'] += int((sel_used > sel_size).sum())
+        table = getTable(sel_size, sel_used, history['thick'][sel], policy['threshold'][sel], policy['growth'][sel], policy['warn'][sel])
+        per, risk, status = fleet_table.classify(table)
+        targets = numpy.asarray(fleet_table.getTargetSizes(table, status))
+        status = numpy.asarray(status)
+        result['warnings'] += int((status == fleet_table.STATUS_WARN).sum())
+
+        #objects at the policy maximum are reported instead of resized
+        max_size = policy['max_size'][sel]
+        resize = status == fleet_table.STATUS_RESIZE
+        blocked = resize & (max_size > 0) & (sel_size >= max_size)
+        resize &= ~blocked
+        result['max_size_reached'] += int(blocked.sum())
+        new_size = numpy.ceil(numpy.where(max_size > 0, numpy.minimum(targets, max_size), targets))
+        resized = sel[resize]
+        result['resizes'] += len(resized)
+        result['grown_gb'] += float((new_size[resize] - sel_size[resize]).sum())/(1024*1024*1024)
+        size[resized] = new_size[resize]
+        #volumes are resized through FSx describe_volumes and update_volume, LUNs through an ONTAP PATCH,
+        #thick volumes list the volume space first
+        resized_luns = history['is_lun'][resized]
+        aws_calls += 2 * int((~resized_luns).sum())
+        ontap_calls += int(resized_luns.sum())
+        ontap_calls += int((~resized_luns & history['thick'][resized]).sum()) * max(1, math.ceil(int((~history['is_lun'][idx]).sum()) / vars.ontap_page_size))
+
+        sel_size = size[sel]
+        headroom_total += float((sel_size - sel_used).sum())
+        if len(sel):
+            result['min_free_percent'] = min(result['min_free_percent'], float(((sel_size - sel_used) * 100 / numpy.maximum(sel_size, 1)).min()))
+
+        #storage capacity check on every volume, excluded ones still consume capacity
+        vols = ~history['is_lun'][idx]
+        vol_idx = idx[vols]
+        consumed = float(numpy.where(history['thick'][vol_idx], size[vol_idx], used[vols]).sum())/(1024*1024*1024)
+        aggr_total = sample['aggr_total'] * storage_capacity / sample['storage_capacity']
+        sc_used_per = consumed/aggr_total*100 if aggr_total else 0
+        if int(sc_used_per * 1.1) > int(sweep_fsx['resize_threshold']):
+            new_capacity = monitoring.getNewStorageCapacity(storage_capacity, aggr_total)
+            result['sc_increases'] += 1
+            result['sc_added_gb'] += new_capacity - storage_capacity
+            storage_capacity = new_capacity
+            aws_calls += 1
+        result['ontap_calls'] += ontap_calls
+        result['aws_calls'] += aws_calls
+
+    result['avg_headroom_gb'] = headroom_total/len(history['samples'])/(1024*1024*1024) if history['samples'] else 0
+    return result
+
+def loadSimulationFleet(path):
+    #offline the fleet configuration comes from a file, vars.py or an SSM parameter as configured
+    if path:
+        return fleet_config.loadFleetConfig(path)
+    return monitoring.getFleetConfig(monitoring.getAwsClients()['ssm'] if vars.fleet_config_source.startswith("ssm:") else None)
+
+def initWorker(history_path, fleet_path):
+    worker_histories['histories'] = loadHistories(history_path)
+    worker_histories['fleet'] = {fsx['fsxId']: fsx for fsx in loadSimulationFleet(fleet_path)}
+
+def simulateFleet(overrides):
+    #totals over every file system of the history for one combination of policy values
+    totals = dict.fromkeys(REPORT_KEYS, 0)
+    totals['min_free_percent'] = 100.0
+    for fsxId, history in worker_histories['histories'].items():
+        fsx = worker_histories['fleet'].get(fsxId)
+        if fsx is None:
+            continue
+        result = simulateFsx(history, fsx, overrides)
+        for key in REPORT_KEYS:
+            if key == "min_free_percent":
+                totals[key] = min(totals[key], result[key])
+            else:
+                totals[key] += result[key]
+    return dict(overrides, **totals)
+
+def getSweep(args):
+    #every combination of the swept values, unswept values stay as configured
+    values = []
+    for key in SWEEP_KEYS:
+        option = getattr(args, key)
+        if option:
+            values.append([(key, float(value) if "." in value else int(value)) for value in option.split(",")])
+    return [dict(combination) for combination in itertools.product(*values)]
+
+def simulate(args):
+    if fleet_table.numpy is None:
+        raise ValueError("NumPy is required to run the simulator")
+    sweep = getSweep(args)
+    start = time.time()
+    initWorker(args.history, args.fleet_config)
+    missing = [fsxId for fsxId in worker_histories['histories'] if fsxId not in worker_histories['fleet']]
+    if missing:
+        logger.warning("Skipping file systems that are not in the fleet configuration: %s", ", ".join(missing))
+    #combinations run in parallel processes, each loads the history once
+    if args.workers > 1 and len(sweep) > 1:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=initWorker, initargs=(args.history, args.fleet_config)) as pool:
+            results = list(pool.map(simulateFleet, sweep, chunksize=max(1, len(sweep) // (args.workers * 4))))
+    else:
+        results = [simulateFleet(overrides) for overrides in sweep]
+    logger.info("Simulated %d combinations in %.1f seconds", len(sweep), time.time() - start)
+    writeReport(results, [key for key in SWEEP_KEYS if getattr(args, key)], args.csv)
+
+def writeReport(results, swept_keys, csv_path):
+    columns = swept_keys + REPORT_KEYS
+    rows = [[round(result[key], 2) if isinstance(result[key], float) else result[key] for key in columns] for result in results]
+    if csv_path:
+        with open(csv_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            writer.writerows(rows)
+    widths = [max(len(column), *(len(str(row[i])) for row in rows)) for i, column in enumerate(columns)]
+    print("  ".join(column.rjust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(str(value).rjust(width) for value, width in zip(row, widths)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Capture FSx ONTAP inventory history and replay it for policy tuning")
+    commands = parser.add_subparsers(dest="command", required=True)
+    capture = commands.add_parser("capture", help="append the current inventory of the fleet to a history file")
+    capture.add_argument("history", help="history file, gzip compressed when it ends with .gz")
+    capture.add_argument("--snapshots", action="store_true", help="also capture the snapshots of every volume")
+    replay = commands.add_parser("simulate", help="replay a history file for every combination of policy values")
+    replay.add_argument("history", help="history file written by capture")
+    replay.add_argument("--fleet-config", help="fleet configuration file, defaults to the configuration in vars.py")
+    for key in SWEEP_KEYS:
+        replay.add_argument("--" + key.replace("_", "-"), dest=key, help="comma separated values of " + key)
+    replay.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="parallel processes")
+    replay.add_argument("--csv", help="also write the report to this CSV file")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "capture":
+            captureFleet(args.history, args.snapshots)
+        else:
+            simulate(args)
+    except (ValueError, OSError) as e:
+        logger.error("%s", e)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s", level=logging.INFO)
+    sys.exit(main())
@@ -16,4 +16,86 @@ internet_access = False
 # if internet access = False, set the below parameters
 smtp_region = ""
 smtp_username_ssm_parameter = ""
-smtp_password_ssm_parameter = ""
\ No newline at end of file
+smtp_password_ssm_parameter = ""
+
+# stop starting new work when fewer than these seconds remain before the lambda timeout
+deadline_safety_margin_in_seconds = 30
+# unfinished work is saved to this S3 bucket and resumed on the next run. Leave empty to use checkpoint_local_path
+checkpoint_s3_bucket = ""
+checkpoint_s3_key = "fsxn-monitoring/checkpoint.json"
+checkpoint_local_path = "/tmp/fsxn_monitoring_checkpoint.json"
+
+# pre-screen utilization with CloudWatch metrics and only fetch objects near the thresholds from ONTAP
+enable_metrics_prescreen = False
+# percentage points below the warning/resize threshold that still count as near the threshold
+metrics_prescreen_margin = 5
+metrics_prescreen_lookback_in_minutes = 60
+
+# delete expired snapshots with one query-based DELETE per volume instead of one request per snapshot
+enable_bulk_snapshot_deletion = False
+# snapshots per DELETE request when a volume holds more than one FlexClone parent snapshot
+bulk_snapshot_deletion_batch_size = 50
+
+# optional structured fleet configuration with per-SVM/volume policy overrides. Takes precedence over fsxList
+# path to a .json/.yaml file packaged with the function or "ssm:<parameter name>"
+fleet_config_source = ""
+
+# long-running service mode (fsxn_monitoring_service.py), ignored by the Lambda function
+# default interval between scans of a file system, override per file system with scan_interval_in_seconds
+service_scan_interval_in_seconds = 300
+# file systems scanned at the same time
+service_max_concurrent_scans = 4
+# a scan stops starting new work after this many seconds, like the Lambda timeout
+service_scan_timeout_in_seconds = 900
+# passwords and the fleet configuration are reloaded after this many seconds
+service_refresh_interval_in_seconds = 3600
+# local health and metrics endpoint, 0 disables it
+service_http_port = 8080
+service_http_address = "127.0.0.1"
+
+# records per page of ONTAP collection responses. Pages are parsed as a stream so memory stays flat
+ontap_page_size = 1000
+ontap_stream_chunk_size = 65536
+
+# concurrent ONTAP reads per file system while taking the inventory, LUNs and volumes are listed per SVM.
+# Snapshots are listed with the same concurrency once the capacity work is done
+inventory_max_workers_per_fsx = 4
+
+# file systems of other accounts or regions set "role_arn" and/or "region" in their fsxList or fleet configuration entry.
+# The role is assumed once and its clients are reused until the credentials expire. The fsx password SSM parameter
+# is read in the account and region of the file system
+max_parallel_account_groups = 8
+assume_role_session_name = "fsxn-monitoring"
+assume_role_duration_in_seconds = 3600
+assume_role_refresh_margin_in_seconds = 300
+
+# profiling of an invocation, enabled by {"profile": true} in the event or FSXN_MONITORING_PROFILE=true in the
+# function environment. cProfile stats and the top allocation sites are written to profile_local_dir
+profile_local_dir = "/tmp"
+# also upload the profile to this S3 bucket when set
+profile_s3_bucket = ""
+profile_s3_prefix = "fsxn-monitoring/profiles/"
+profile_top_n = 25
+profile_traceback_frames = 1
+
+# before growing a volume, delete the fewest expired snapshots (older than snapshot_age_threshold_in_days, not
+# FlexClone parents) whose ONTAP reclaimable space brings it under resize_threshold. Resize only when that is not enough
+enable_snapshot_reclaim = False
+
+# list only the volumes and LUNs above the lowest warning floor (minus utilization_filter_margin percentage points)
+# with ONTAP query filters on their space fields. A full scan of every object refreshes the storage capacity totals
+# and runs snapshot retention on all volumes every utilization_filter_full_scan_interval_in_seconds
+enable_utilization_filter = False
+utilization_filter_full_scan_interval_in_seconds = 3600
+utilization_filter_margin = 5
+
+# let ONTAP autosize grow thin provisioned volumes in real time at their resize_threshold up to max_size_in_gb.
+# Each run lists the autosize settings of the thin volumes, corrects the ones that drifted from the policy and
+# keeps checking the storage capacity headroom autosize depends on. Thick volumes and LUNs are resized as before
+enable_autosize_reconciliation = False
+# autosize maximum of volumes without max_size_in_gb, in percent of the volume size when autosize is configured
+autosize_maximum_percent = 200
+
+# share ONTAP volume, LUN and aggregate details fetched more than once in a run. Identical concurrent requests are
+# merged and a PATCH or DELETE of a resource drops its cached responses
+ontap_response_cache = True